@@ -0,0 +1,76 @@
+"""
+Microbenchmark of coercing records to a Socrata schema one record at a time
+with SocrataDataset.mod_dtype, against the whole batch with mod_dtype_batch.
+
+Run from the repository folder:
+    python -m benchmarks.bench_coerce --records 20000 --repeat 5
+
+"""
+import argparse
+import random
+import timeit
+
+from socrata_util import SocrataDataset
+from tests.fakes import DATASET_ID, FakeSocrata, ListLogger
+
+
+COL_DTYPE_DICT = {
+    'id': 'text', 'road_name': 'text', 'direction': 'text', 'start_date': 'calendar_date',
+    'vehicle_impact': 'text', 'lanes_closed': 'number', 'speed_limit': 'number',
+    'latitude': 'number', 'longitude': 'number', 'is_verified': 'checkbox',
+    'geometry': 'point', 'description': 'text'
+}
+FLOAT_FIELDS = ['latitude', 'longitude']
+
+
+def make_recs(n_recs, seed=0):
+    """
+    Build synthetic work zone records, with some empty, missing and extra fields.
+
+    """
+    rand = random.Random(seed)
+    recs = []
+    for i in range(n_recs):
+        rec = {
+            'id': i, 'road_name': 'I-{}'.format(rand.randint(1, 99)), 'direction': rand.choice(['north', 'south', '']),
+            'start_date': '2026-01-01T00:00:00', 'vehicle_impact': rand.choice(['all-lanes-open', None]),
+            'lanes_closed': str(rand.randint(0, 3)), 'speed_limit': rand.choice(['45', 55, '']),
+            'latitude': str(rand.uniform(-90, 90)), 'longitude': rand.uniform(-180, 180),
+            'is_verified': rand.choice([0, 1, 'true', None]),
+            'geometry': {'type': 'Point', 'coordinates': [0, 0]}, 'not_in_schema': 'x'
+        }
+        if rand.random() < 0.3:
+            rec['description'] = 'Lane closure {}'.format(i)
+        recs.append(rec)
+    return recs
+
+
+def make_dataset():
+    return SocrataDataset(DATASET_ID, socrata_client=FakeSocrata(), float_fields=FLOAT_FIELDS,
+                          lazy_metadata=True, logger=ListLogger())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    dataset = make_dataset()
+    recs = make_recs(args.records)
+    per_rec = [dataset.mod_dtype(rec, COL_DTYPE_DICT, FLOAT_FIELDS) for rec in recs]
+    assert per_rec == dataset.mod_dtype_batch(recs, COL_DTYPE_DICT, FLOAT_FIELDS)
+
+    timings = {
+        'mod_dtype': min(timeit.repeat(lambda: [dataset.mod_dtype(rec, COL_DTYPE_DICT, FLOAT_FIELDS) for rec in recs],
+                                       number=1, repeat=args.repeat)),
+        'mod_dtype_batch': min(timeit.repeat(lambda: dataset.mod_dtype_batch(recs, COL_DTYPE_DICT, FLOAT_FIELDS),
+                                             number=1, repeat=args.repeat))
+    }
+    for name, seconds in timings.items():
+        print('{:<16} {:>8.1f} ms  {:>8.2f} us/record'.format(name, seconds * 1000, seconds / args.records * 1e6))
+    print('speedup          {:>8.2f}x'.format(timings['mod_dtype'] / timings['mod_dtype_batch']))
+
+
+if __name__ == '__main__':
+    main()
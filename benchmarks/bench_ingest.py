@@ -0,0 +1,81 @@
+"""
+Benchmark of a full ingest run (read the registry, schedule, trigger the due
+feeds and write back their ingest times) on synthetic feed registries of
+different sizes, against the in-memory Socrata and Lambda stand-ins.
+
+Run from the repository folder:
+    python -m benchmarks.bench_ingest --feeds 100 1000 10000 100000
+
+"""
+import argparse
+from datetime import datetime
+import time
+import tracemalloc
+
+from tests.fakes import FakeLambda, FakeSocrata, make_registry, make_rows
+
+
+def measure(func):
+    """
+    Call `func` and measure its wall time and peak traced memory.
+
+    Returns:
+        A tuple of (wall time in seconds, peak memory in MB).
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    wall_s = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return wall_s, peak / 1024 / 1024
+
+
+def run(n_feeds, latency=0, max_workers=16, batch_size=None, defer_writeback=False):
+    """
+    Plan and then run ingest once on a registry of `n_feeds` feeds. The rows
+    are last ingested 0 to 19 minutes ago with frequencies of 30s to 1h, so
+    about half of the feeds are due.
+
+    Returns:
+        Dictionary object with the wall times, peak memory and call counts of
+        the run.
+    """
+    now = datetime(2026, 1, 1)
+    socrata = FakeSocrata(make_rows(n_feeds, now=now))
+    registry, socrata, lambda_client = make_registry(socrata=socrata, lambda_client=FakeLambda(latency=latency),
+                                                     clock=lambda: now, max_workers=max_workers,
+                                                     batch_size=batch_size, defer_writeback=defer_writeback)
+    result = {}
+    result['plan_s'], result['plan_mb'] = measure(lambda: result.update(due=len(registry.plan())))
+    n_get = socrata.n_get
+    result['ingest_s'], result['ingest_mb'] = measure(registry.ingest)
+    result.update({
+        'triggered': registry.n_ingest_triggered,
+        'gets': socrata.n_get - n_get,
+        'upserts': socrata.n_upsert,
+        'invokes': lambda_client.n_invoke
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--feeds', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0, help='seconds per stub Lambda invoke')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--defer-writeback', action='store_true', help='write back ingest times in batches')
+    args = parser.parse_args()
+
+    columns = ['feeds', 'due', 'plan_s', 'plan_mb', 'ingest_s', 'ingest_mb', 'triggered', 'gets', 'upserts', 'invokes']
+    print(' '.join('{:>10}'.format(column) for column in columns))
+    for n_feeds in args.feeds:
+        result = run(n_feeds, args.latency, args.workers, args.batch_size, args.defer_writeback)
+        result['feeds'] = n_feeds
+        print(' '.join('{:>10.3f}'.format(result[column]) if isinstance(result[column], float) else '{:>10}'.format(result[column])
+                       for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark of triggering due feeds against a stub Lambda client with a fixed
+invoke latency, for different numbers of concurrent workers.
+
+Run from the repository folder:
+    python -m benchmarks.bench_trigger --feeds 200 --latency 0.02 --workers 1 4 16
+
+"""
+import argparse
+from datetime import datetime, timedelta
+import time
+
+from tests.fakes import FakeLambda, make_registry, make_rows
+
+
+def run(n_feeds, latency, max_workers, batch_size=None):
+    """
+    Trigger `n_feeds` due feeds once.
+
+    Returns:
+        Dictionary object with the wall time and call counts of the run.
+    """
+    now = datetime(2026, 1, 1)
+    rows = make_rows(n_feeds, now=now, frequencies=['1h'], last_ingest_offsets=[timedelta(hours=2)])
+    registry, socrata, lambda_client = make_registry(rows, lambda_client=FakeLambda(latency=latency),
+                                                     clock=lambda: now, max_workers=max_workers,
+                                                     batch_size=batch_size, defer_writeback=True)
+    start = time.perf_counter()
+    registry.ingest()
+    return {
+        'wall_s': time.perf_counter() - start,
+        'triggered': registry.n_ingest_triggered,
+        'invokes': lambda_client.n_invoke,
+        'max_in_flight': lambda_client.max_in_flight,
+        'upserts': socrata.n_upsert
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--feeds', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per stub Lambda invoke')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--batch-size', type=int, default=None)
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>10} {:>8} {:>14} {:>8}'.format('workers', 'wall_s', 'triggered', 'invokes', 'max_in_flight', 'upserts'))
+    for max_workers in args.workers:
+        result = run(args.feeds, args.latency, max_workers, args.batch_size)
+        print('{:>8} {:>10.3f} {:>10} {:>8} {:>14} {:>8}'.format(
+            max_workers, result['wall_s'], result['triggered'], result['invokes'], result['max_in_flight'], result['upserts']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Long-running process that triggers a separate ingestion lambda function based on
+the WZDx Feed Registry Socrata dataset, as an alternative to invoking
+lambda__wzdx_trigger_ingest.py on a fixed CloudWatch schedule.
+
+"""
+from __future__ import print_function
+
+import json
+import logging
+import os
+import signal
+import threading
+
+from s3_helper import S3Helper
+from state_store import S3StateStore, SQLiteStateStore
+from wzdx_registry import WZDxFeedRegistry
+
+
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+DATASET_ID = os.environ.get('DATASET_ID')
+LAMBDA_TO_TRIGGER = os.environ.get('LAMBDA_TO_TRIGGER')
+SOCRATA_PARAMS = os.environ.get('SOCRATA_PARAMS')
+AWS_PROFILE = os.environ.get('AWS_PROFILE')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 1))
+REFRESH_INTERVAL = int(os.environ.get('REFRESH_INTERVAL', 300))
+WRITEBACK_FLUSH_INTERVAL = int(os.environ.get('WRITEBACK_FLUSH_INTERVAL', 60))
+SOCRATA_RATE_LIMIT = float(os.environ.get('SOCRATA_RATE_LIMIT', 0)) or None
+LAMBDA_RATE_LIMIT = float(os.environ.get('LAMBDA_RATE_LIMIT', 0)) or None
+STATE_DB = os.environ.get('STATE_DB')
+STATE_S3_BUCKET = os.environ.get('STATE_S3_BUCKET')
+STATE_S3_KEY = os.environ.get('STATE_S3_KEY', 'wzdx_trigger_ingest/feed_state.json')
+SPREAD_SCHEDULE = os.environ.get('SPREAD_SCHEDULE', 'false').lower() == 'true'
+TRIGGER_BUDGET = int(os.environ.get('TRIGGER_BUDGET', 0)) or None
+
+if None in [DATASET_ID, LAMBDA_TO_TRIGGER, SOCRATA_PARAMS]:
+    logger.error('Required ENV variable(s) not found. Please make sure you have specified the following ENV variables: DATASET_ID, LAMBDA_TO_TRIGGER, SOCRATA_PARAMS')
+    exit()
+
+
+def main():
+    """
+    Run the trigger loop until SIGINT or SIGTERM is received.
+
+    """
+    stop_event = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info('Received signal {}. Shutting down.'.format(signum))
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    state_store = None
+    if STATE_S3_BUCKET:
+        state_store = S3StateStore(STATE_S3_BUCKET, STATE_S3_KEY, s3_helper=S3Helper(aws_profile=AWS_PROFILE), print_func=logger.info)
+    elif STATE_DB:
+        state_store = SQLiteStateStore(STATE_DB)
+
+    wzdx_registry = WZDxFeedRegistry(DATASET_ID,
+                                    socrata_params=json.loads(SOCRATA_PARAMS),
+                                    lambda_to_trigger=LAMBDA_TO_TRIGGER,
+                                    aws_profile=AWS_PROFILE,
+                                    defer_writeback=True,
+                                    writeback_flush_interval=WRITEBACK_FLUSH_INTERVAL,
+                                    max_workers=MAX_WORKERS,
+                                    lazy_metadata=True,
+                                    incremental=True,
+                                    rate_limit=SOCRATA_RATE_LIMIT,
+                                    lambda_rate_limit=LAMBDA_RATE_LIMIT,
+                                    state_store=state_store,
+                                    spread_schedule=SPREAD_SCHEDULE,
+                                    trigger_budget=TRIGGER_BUDGET,
+                                    logger=logger)
+    wzdx_registry.run_forever(stop_event, refresh_interval=REFRESH_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""
+Scheduler for deciding which WZDx feeds are due for ingestion.
+
+"""
+from datetime import datetime, timedelta
+import functools
+import heapq
+import itertools
+import json
+import math
+import re
+import zlib
+
+
+TIME_UNIT_DICT = {'h': 'hours', 'm': 'minutes', 's': 'seconds'}
+TIME_REGEX = re.compile(r'(\d+)(\w+)')
+
+
+@functools.lru_cache(maxsize=None)
+def parse_frequency(update_freq):
+    """
+    Parse the update frequency of a feed into a timedelta.
+
+    Parameters:
+        update_freq: string representation of the update frequency of a feed,
+            in the format of concatenated number followed by h/m/s for
+            hours/minutes/seconds (e.g. '12h', '5m', '30s').
+
+    Returns:
+        Timedelta object.
+    """
+    time_num, time_unit = TIME_REGEX.findall(update_freq)[0]
+    return timedelta(**{TIME_UNIT_DICT[time_unit]: int(time_num)})
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO formatted timestamp string. The standard library parser
+    handles the timestamps written by this package and by Socrata; dateutil is
+    only imported for any other format.
+
+    Parameters:
+        value: ISO formatted timestamp string.
+
+    Returns:
+        Datetime object.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        import dateutil.parser
+        return dateutil.parser.parse(value)
+
+
+class Feed(object):
+    """
+    Compact representation of a feed registry record. Holds only what the
+    scheduler needs (the parsed update frequency and the last ingest time as an
+    epoch) and what the ingestion lambda is sent, with the serialized payload
+    cached so it is built once per registry read instead of once per trigger.
+
+    """
+    __slots__ = ('row_id', 'feedname', 'update_freq', 'frequency_seconds', 'last_ingest_time',
+                 'last_ingest_epoch', 'updated_at', 'fields', '_fields_json')
+
+    def __init__(self, row, payload_fields=None):
+        """
+        Initialization function of the Feed class.
+
+        Parameters:
+            row: dictionary object of a feed registry record, including the
+                system fields (e.g. ':id').
+            payload_fields: Optional array of field names to send to the
+                ingestion lambda. Defaults to all fields of the record except the
+                Socrata system fields other than ':id'. ':id' and 'feedname' are
+                always sent.
+        """
+        self.row_id = row.get(':id') or row['feedname']
+        self.feedname = row['feedname']
+        self.updated_at = row.get(':updated_at')
+        self.update_freq = row.get('datafeed_frequency_update')
+        if not self.update_freq:
+            raise ValueError('Feed {} has no datafeed_frequency_update.'.format(self.feedname))
+        self.frequency_seconds = parse_frequency(self.update_freq).total_seconds()
+        self.last_ingest_time = None
+        self.last_ingest_epoch = None
+        if row.get('lastingestedtosandbox'):
+            self.set_last_ingest_time(row['lastingestedtosandbox'])
+
+        if payload_fields:
+            keep = set(payload_fields) | {':id', 'feedname'}
+            self.fields = {k: v for k, v in row.items() if k in keep}
+        else:
+            self.fields = {k: v for k, v in row.items() if not k.startswith(':') or k == ':id'}
+        # the last ingest time changes on every trigger, so it is spliced into
+        # the payload instead of being part of the cached serialization
+        self.fields.pop('lastingestedtosandbox', None)
+        self._fields_json = None
+
+    def set_last_ingest_time(self, last_ingest_time):
+        """
+        Set the last ingest time of the feed.
+
+        Parameters:
+            last_ingest_time: ISO formatted timestamp string.
+        """
+        self.last_ingest_time = last_ingest_time
+        self.last_ingest_epoch = parse_timestamp(last_ingest_time).timestamp()
+
+    def mark_ingested(self, ingest_time):
+        """
+        Record that ingestion of the feed was triggered.
+
+        Parameters:
+            ingest_time: Datetime object of the time ingestion was triggered.
+        """
+        self.last_ingest_time = ingest_time.isoformat()
+        self.last_ingest_epoch = ingest_time.timestamp()
+
+    @property
+    def next_ingest_epoch(self):
+        """
+        Epoch time of the next ingestion. Feeds that have never been ingested
+        are due immediately (-inf).
+
+        """
+        if self.last_ingest_epoch is None:
+            return float('-inf')
+        return self.last_ingest_epoch + self.frequency_seconds
+
+    def to_json(self):
+        """
+        Serialize the feed as sent to the ingestion lambda.
+
+        Returns:
+            Bytes of the JSON object.
+        """
+        if self._fields_json is None:
+            self._fields_json = json.dumps(self.fields).encode('utf-8')
+        if self.last_ingest_time is None:
+            return self._fields_json
+        last_ingest_json = json.dumps(self.last_ingest_time).encode('utf-8')
+        if self.fields:
+            return self._fields_json[:-1] + b', "lastingestedtosandbox": ' + last_ingest_json + b'}'
+        return b'{"lastingestedtosandbox": ' + last_ingest_json + b'}'
+
+    def writeback_record(self):
+        """
+        Record used to write the last ingest time back to the feed registry.
+        Only the row ID and the updated field are sent.
+
+        Returns:
+            Dictionary object.
+        """
+        return {':id': self.row_id, 'lastingestedtosandbox': self.last_ingest_time}
+
+
+def get_phase(feed_id):
+    """
+    Deterministic phase of a feed within its update frequency window, so that
+    the same feed always lands on the same offset, on any host.
+
+    Parameters:
+        feed_id: Socrata row ID (or feed name) of the feed.
+
+    Returns:
+        Fraction of the window, between 0 and 1.
+    """
+    return zlib.crc32(str(feed_id).encode('utf-8')) / 2.0 ** 32
+
+
+class FeedScheduler(object):
+    """
+    Min-heap of feeds keyed on their next ingestion time. Frequencies and last
+    ingest times are parsed once per change instead of once per run, and each
+    run only pops the feeds that are due. Feeds held back until a retry time
+    wait in a second heap and keep their original due time as priority, so
+    they are popped ahead of feeds that became due after them.
+
+    """
+    def __init__(self, spread=False):
+        """
+        Initialization function of the FeedScheduler class.
+
+        Parameters:
+            spread: Optional boolean. If True, each feed is scheduled on a
+                fixed per-feed offset within its update frequency window
+                instead of exactly one frequency after its last ingestion, so
+                feeds sharing a frequency do not drift into lockstep.
+        """
+        self.spread = spread
+        self.heap = []
+        # (retry time, due time, seq, feed ID) of feeds held back until a retry time
+        self.held = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def next_ingest_epoch(self, feed):
+        """
+        Get the next ingestion time of a feed under the scheduling policy.
+
+        With spread set, a feed is due at the first time that is at least half a
+        frequency after its last ingestion and falls on its phase (see
+        get_phase). Once on its phase, a feed is triggered once per frequency,
+        on the same offset every time.
+
+        Parameters:
+            feed: Feed object.
+
+        Returns:
+            Epoch time (-inf if the feed has never been ingested).
+        """
+        frequency = feed.frequency_seconds
+        if not self.spread or feed.last_ingest_epoch is None or frequency <= 0:
+            return feed.next_ingest_epoch
+        phase = get_phase(feed.row_id) * frequency
+        earliest = feed.last_ingest_epoch + frequency / 2.0
+        return phase + math.ceil((earliest - phase) / frequency) * frequency
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, feed, not_before=None):
+        """
+        Add a feed to the schedule, or reschedule it if its update frequency or
+        last ingested time has changed since it was last scheduled.
+
+        Parameters:
+            feed: Feed object.
+            not_before: Optional epoch time. If given, the feed is not
+                due before this time, e.g. to back off after a failure. It
+                still sorts by its own due time once this time has passed.
+        """
+        key = (feed.update_freq, feed.last_ingest_time)
+        entry = self.entries.get(feed.row_id)
+        if entry and entry['key'] == key:
+            entry['feed'] = feed
+            return
+        seq = next(self.counter)
+        next_ingest_epoch = self.next_ingest_epoch(feed)
+        self.entries[feed.row_id] = {'seq': seq, 'key': key, 'feed': feed}
+        if not_before and not_before > next_ingest_epoch:
+            heapq.heappush(self.held, (not_before, next_ingest_epoch, seq, feed.row_id))
+        else:
+            heapq.heappush(self.heap, (next_ingest_epoch, seq, feed.row_id))
+        if len(self.heap) + len(self.held) > 2 * len(self.entries) + 100:
+            self._compact()
+
+    def get(self, feed_id):
+        """
+        Get the scheduled Feed object of a feed.
+
+        Parameters:
+            feed_id: Socrata row ID (or feed name) of the feed.
+
+        Returns:
+            Feed object, or None if the feed is not scheduled.
+        """
+        entry = self.entries.get(feed_id)
+        return entry['feed'] if entry else None
+
+    def remove(self, feed_id):
+        """
+        Remove a feed from the schedule. Its heap entry is discarded lazily.
+
+        Parameters:
+            feed_id: Socrata row ID (or feed name) of the feed.
+        """
+        self.entries.pop(feed_id, None)
+
+    def sync(self, feeds):
+        """
+        Bring the schedule in line with the given feeds: add new feeds,
+        reschedule changed ones and remove those no longer present.
+
+        Parameters:
+            feeds: array of Feed objects.
+        """
+        feed_ids = set()
+        for feed in feeds:
+            feed_ids.add(feed.row_id)
+            self.update(feed)
+        for feed_id in list(self.entries):
+            if feed_id not in feed_ids:
+                self.remove(feed_id)
+
+    def _is_current(self, seq, feed_id):
+        entry = self.entries.get(feed_id)
+        return entry is not None and entry['seq'] == seq
+
+    def _compact(self):
+        self.heap = [item for item in self.heap if self._is_current(item[1], item[2])]
+        heapq.heapify(self.heap)
+        self.held = [item for item in self.held if self._is_current(item[2], item[3])]
+        heapq.heapify(self.held)
+
+    def _drop_stale(self):
+        while self.heap and not self._is_current(self.heap[0][1], self.heap[0][2]):
+            heapq.heappop(self.heap)
+        while self.held and not self._is_current(self.held[0][2], self.held[0][3]):
+            heapq.heappop(self.held)
+
+    def _release_held(self, now_epoch):
+        while self.held and self.held[0][0] <= now_epoch:
+            _, next_ingest_epoch, seq, feed_id = heapq.heappop(self.held)
+            if self._is_current(seq, feed_id):
+                heapq.heappush(self.heap, (next_ingest_epoch, seq, feed_id))
+
+    def pop_due(self, now):
+        """
+        Pop all feeds whose next ingestion time (and retry time, if held) is
+        before `now`, most overdue first. Popped feeds leave the schedule until
+        they are passed to `update` again.
+
+        Parameters:
+            now: Datetime object of the current time.
+
+        Returns:
+            Array of the due Feed objects.
+        """
+        now_epoch = now.timestamp()
+        due_feeds = []
+        self._release_held(now_epoch)
+        self._drop_stale()
+        while self.heap and self.heap[0][0] < now_epoch:
+            _, _, feed_id = heapq.heappop(self.heap)
+            due_feeds.append(self.entries.pop(feed_id)['feed'])
+            self._drop_stale()
+        return due_feeds
+
+    def next_due_epoch(self):
+        """
+        Get the earliest next ingestion time among scheduled feeds.
+
+        Returns:
+            Epoch time, or None if no feeds are scheduled.
+        """
+        self._drop_stale()
+        next_due_epochs = []
+        if self.heap:
+            next_due_epochs.append(self.heap[0][0])
+        if self.held:
+            next_due_epochs.append(self.held[0][0])
+        if not next_due_epochs:
+            return None
+        return min(next_due_epochs)
+
+    def time_until_next_due(self, now):
+        """
+        Get the number of seconds until the next feed is due.
+
+        Parameters:
+            now: Datetime object of the current time.
+
+        Returns:
+            Number of seconds (0 if a feed is already due), or None if no feeds
+            are scheduled.
+        """
+        next_due_epoch = self.next_due_epoch()
+        if next_due_epoch is None:
+            return None
+        return max(0, next_due_epoch - now.timestamp())
@@ -9,6 +9,9 @@ import logging
 import os
 import traceback
 
+from s3_helper import invalidate_aws_cache
+from socrata_util import invalidate_socrata_cache
+from state_store import S3StateStore
 from wzdx_registry import WZDxFeedRegistry
 
 
@@ -19,22 +22,104 @@ logger.setLevel(logging.INFO)  # necessary to make sure aws is logging
 DATASET_ID = os.environ.get('DATASET_ID')
 LAMBDA_TO_TRIGGER = os.environ.get('LAMBDA_TO_TRIGGER')
 SOCRATA_PARAMS = os.environ.get('SOCRATA_PARAMS')
+DEFER_WRITEBACK = os.environ.get('DEFER_WRITEBACK', 'false').lower() == 'true'
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 1))
+POOL_SIZE = int(os.environ.get('POOL_SIZE', 10))
+INCREMENTAL = os.environ.get('INCREMENTAL', 'false').lower() == 'true'
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 0)) or None
+SOCRATA_RATE_LIMIT = float(os.environ.get('SOCRATA_RATE_LIMIT', 0)) or None
+LAMBDA_RATE_LIMIT = float(os.environ.get('LAMBDA_RATE_LIMIT', 0)) or None
+STATE_S3_BUCKET = os.environ.get('STATE_S3_BUCKET')
+STATE_S3_KEY = os.environ.get('STATE_S3_KEY', 'wzdx_trigger_ingest/feed_state.json')
+SPREAD_SCHEDULE = os.environ.get('SPREAD_SCHEDULE', 'false').lower() == 'true'
+TRIGGER_BUDGET = int(os.environ.get('TRIGGER_BUDGET', 0)) or None
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', 0)) or None
+# added to the remaining invocation time when deriving the lease from it
+LEASE_MARGIN_SECONDS = 60
 
 if None in [DATASET_ID, LAMBDA_TO_TRIGGER, SOCRATA_PARAMS]:
     logger.error('Required ENV variable(s) not found. Please make sure you have specified the following ENV variables: DATASET_ID, LAMBDA_TO_TRIGGER, SOCRATA_PARAMS')
     exit()
 
 
+# kept across warm invocations so the clients, sessions and dataset metadata
+# are only set up on cold start
+wzdx_registry = None
+
+
+def get_wzdx_registry():
+    """
+    Get the WZDxFeedRegistry for this lambda container, creating it if needed.
+
+    """
+    global wzdx_registry
+    if wzdx_registry is None:
+        state_store = None
+        if STATE_S3_BUCKET:
+            state_store = S3StateStore(STATE_S3_BUCKET, STATE_S3_KEY, print_func=logger.info)
+        wzdx_registry = WZDxFeedRegistry(DATASET_ID,
+                                        socrata_params=json.loads(SOCRATA_PARAMS),
+                                        lambda_to_trigger=LAMBDA_TO_TRIGGER,
+                                        defer_writeback=DEFER_WRITEBACK,
+                                        max_workers=MAX_WORKERS,
+                                        pool_size=POOL_SIZE,
+                                        lazy_metadata=True,
+                                        incremental=INCREMENTAL,
+                                        batch_size=BATCH_SIZE,
+                                        rate_limit=SOCRATA_RATE_LIMIT,
+                                        lambda_rate_limit=LAMBDA_RATE_LIMIT,
+                                        state_store=state_store,
+                                        spread_schedule=SPREAD_SCHEDULE,
+                                        trigger_budget=TRIGGER_BUDGET,
+                                        logger=logger)
+    return wzdx_registry
+
+
+def invalidate_cache():
+    """
+    Drop the cached registry, clients and sessions, e.g. after credentials
+    rotate. They will be recreated on the next invocation.
+
+    """
+    global wzdx_registry
+    wzdx_registry = None
+    invalidate_aws_cache()
+    invalidate_socrata_cache()
+
+
 def lambda_handler(event=None, context=None):
     """
     AWS Lambda handler.
 
+    Pass in an event with `"dry_run": true` to only log the feeds that would be
+    triggered. Pass in an event with `"invalidate_cache": true` to force the
+    cached clients to be rebuilt. The cache is also dropped whenever a run
+    fails, so that the next invocation starts from fresh connections and
+    credentials. Feeds claimed in the state store are leased for the rest of
+    the invocation's time (or LEASE_SECONDS, if set).
     """
-    wzdx_registry = WZDxFeedRegistry(DATASET_ID,
-                                    socrata_params=json.loads(SOCRATA_PARAMS),
-                                    lambda_to_trigger=LAMBDA_TO_TRIGGER,
-                                    logger=logger)
-    wzdx_registry.ingest()
+    event = event or {}
+    if event.get('invalidate_cache'):
+        invalidate_cache()
+    try:
+        registry = get_wzdx_registry()
+        if LEASE_SECONDS:
+            registry.lease_seconds = LEASE_SECONDS
+        elif context is not None:
+            # hold leases for as long as this invocation may run
+            registry.lease_seconds = context.get_remaining_time_in_millis() / 1000.0 + LEASE_MARGIN_SECONDS
+        if event.get('dry_run'):
+            planned = registry.ingest(dry_run=True)
+            return {'n_ingest_planned': len(planned)}
+        registry.ingest()
+    except Exception:
+        logger.error(traceback.format_exc())
+        invalidate_cache()
+        raise
+    return {
+        'n_ingest_triggered': registry.n_ingest_triggered,
+        'seconds_until_next_due': registry.time_until_next_due()
+    }
 
 
 if __name__ == '__main__':
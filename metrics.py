@@ -0,0 +1,149 @@
+"""
+Helper class for collecting per-phase timings and counts of a run.
+
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import math
+import threading
+import time
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted array of numbers.
+
+    Parameters:
+        sorted_values: sorted array of numbers
+        pct: percentile to return, between 0 and 100
+
+    Returns:
+        Value at the given percentile, or None if there are no values.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+class Metrics(object):
+    """
+    Collects timings and counters of named operations, and summarizes them as a
+    CloudWatch Embedded Metric Format (EMF) log line.
+
+    """
+    def __init__(self, namespace='WZDxFeedRegistry', dimensions=None):
+        """
+        Initialization function of the Metrics class.
+
+        Parameters:
+            namespace: CloudWatch namespace the metrics are published under.
+            dimensions: Optional dictionary object of CloudWatch dimension names
+                and values to attach to the metrics (e.g. {'DatasetId': 'x123-bc12'}).
+        """
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drop all timings and counters collected so far.
+
+        """
+        with self.lock:
+            self.timings = defaultdict(list)
+            self.counters = defaultdict(int)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Context manager that records how long its block took under `name`. The
+        time is recorded even if the block raises.
+
+        Parameters:
+            name: name of the timed operation
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.timings[name].append(elapsed_ms)
+
+    def incr(self, name, value=1):
+        """
+        Increment the counter `name`.
+
+        Parameters:
+            name: name of the counter
+            value: amount to increment the counter by
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def summary(self):
+        """
+        Summarize the timings and counters collected so far.
+
+        Returns:
+            Dictionary object with a 'timings' field mapping each timed operation
+            to its call count, total, p50 and p95 latency in milliseconds, and a
+            'counters' field mapping each counter to its value.
+        """
+        with self.lock:
+            timings = {name: sorted(values) for name, values in self.timings.items()}
+            counters = dict(self.counters)
+        return {
+            'timings': {name: {
+                'count': len(values),
+                'total_ms': round(sum(values), 3),
+                'p50_ms': round(percentile(values, 50), 3),
+                'p95_ms': round(percentile(values, 95), 3)
+            } for name, values in timings.items()},
+            'counters': counters
+        }
+
+    def to_emf(self):
+        """
+        Format the summary as a CloudWatch Embedded Metric Format object.
+
+        Returns:
+            Dictionary object in the CloudWatch EMF format.
+        """
+        summary = self.summary()
+        out = dict(self.dimensions)
+        metric_defs = []
+        for name, stats in summary['timings'].items():
+            for stat in ['count', 'p50_ms', 'p95_ms']:
+                metric_name = '{}.{}'.format(name, stat)
+                out[metric_name] = stats[stat]
+                metric_defs.append({'Name': metric_name, 'Unit': 'Count' if stat == 'count' else 'Milliseconds'})
+        for name, value in summary['counters'].items():
+            out[name] = value
+            metric_defs.append({'Name': name, 'Unit': 'Count'})
+        out['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [list(self.dimensions)],
+                'Metrics': metric_defs
+            }]
+        }
+        return out
+
+    def emit(self, print_func=print):
+        """
+        Write the summary as a single JSON line. When printed to stdout in AWS
+        Lambda, CloudWatch picks the line up as metrics. Nothing is written if
+        nothing has been collected.
+
+        Parameters:
+            print_func: function used to write the line. Defaults to print, since
+                EMF lines must not carry a log prefix.
+        """
+        if not self.timings and not self.counters:
+            return
+        print_func(json.dumps(self.to_emf()))
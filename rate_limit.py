@@ -0,0 +1,243 @@
+"""
+Helper classes for pacing and retrying calls to rate limited APIs (Socrata,
+AWS Lambda).
+
+"""
+import random
+import threading
+import time
+
+
+# HTTP status codes and AWS error codes that mean the caller is being throttled
+THROTTLE_STATUS_CODES = (429, 503)
+THROTTLE_ERROR_CODES = ('TooManyRequestsException', 'ThrottlingException', 'Throttling',
+                        'ThrottledException', 'RequestLimitExceeded', 'SlowDown')
+
+
+def get_status_code(response):
+    """
+    Get the HTTP status code of a response, if any.
+
+    Parameters:
+        response: requests.Response object or a boto3 response/error dictionary.
+
+    Returns:
+        Integer status code, or None.
+    """
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return getattr(response, 'status_code', None)
+
+
+def is_throttled(response):
+    """
+    Check if a response (or the response attached to an exception) signals
+    throttling.
+
+    Parameters:
+        response: requests.Response object or a boto3 response/error dictionary.
+
+    Returns:
+        Boolean (True/False)
+    """
+    if isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES:
+        return True
+    return get_status_code(response) in THROTTLE_STATUS_CODES
+
+
+def get_retry_after(response):
+    """
+    Get the number of seconds a throttled response asks the caller to wait.
+
+    Parameters:
+        response: requests.Response object.
+
+    Returns:
+        Number of seconds, or None if the response has no numeric Retry-After
+        header.
+    """
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=30):
+    """
+    Exponential backoff with full jitter, so that callers throttled at the same
+    time do not all retry at the same time.
+
+    Parameters:
+        attempt: number of the retry, starting at 1.
+        base_delay: upper bound of the delay of the first retry, in seconds.
+        max_delay: upper bound of any delay, in seconds.
+
+    Returns:
+        Number of seconds to wait.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket allowing `rate` calls per second on average, with
+    bursts of up to `capacity` calls.
+
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        Initialization function of the TokenBucket class.
+
+        Parameters:
+            rate: number of tokens added per second.
+            capacity: maximum number of tokens held. Defaults to one second's
+                worth of tokens.
+        """
+        self.rate = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available.
+
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limit on the number of calls in flight that adapts AIMD style: it grows by
+    about one per round of successful calls and is halved whenever a call is
+    throttled.
+
+    """
+    def __init__(self, max_limit, min_limit=1, decrease_factor=0.5):
+        """
+        Initialization function of the AdaptiveConcurrency class.
+
+        Parameters:
+            max_limit: maximum (and initial) number of calls in flight.
+            min_limit: minimum number of calls in flight.
+            decrease_factor: factor the limit is multiplied by on throttling.
+        """
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait until a call may start.
+
+        """
+        with self.condition:
+            while self.in_flight >= max(self.min_limit, int(self.limit)):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        """
+        Mark a call as done and adjust the limit.
+
+        Parameters:
+            throttled: Boolean indicating if the call was throttled.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class RateLimiter(object):
+    """
+    Paces calls to an API with a token bucket and an adaptive concurrency
+    limit, and retries throttled calls with jittered exponential backoff. One
+    instance should be shared by all threads calling the same API.
+
+    """
+    def __init__(self, name, rate=None, burst=None, max_concurrency=10, max_retries=5,
+                 base_delay=0.5, max_delay=30, print_func=print, metrics=None):
+        """
+        Initialization function of the RateLimiter class.
+
+        Parameters:
+            name: name of the API, used in log lines and metric names.
+            rate: Optional maximum number of calls per second. Calls are not
+                paced if not given.
+            burst: Optional number of calls that may be made at once before the
+                rate applies. Defaults to one second's worth of calls.
+            max_concurrency: maximum number of calls in flight at once.
+            max_retries: number of times a throttled call is retried before its
+                error (or throttled response) is returned to the caller.
+            base_delay: upper bound in seconds of the delay before the first
+                retry. Doubles on each following retry.
+            max_delay: upper bound in seconds of any delay between retries.
+            print_func: function used to log throttling.
+            metrics: Optional Metrics object in which to count throttled calls.
+        """
+        self.name = name
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.print_func = print_func
+        self.metrics = metrics
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call `func` with the given arguments once the rate and concurrency
+        limits allow it. Calls that raise an error carrying a throttled
+        response, or that return a throttled response, are retried.
+
+        Parameters:
+            func: function to call.
+
+        Returns:
+            The return value of func.
+        """
+        attempt = 0
+        while True:
+            if self.bucket:
+                self.bucket.acquire()
+            self.concurrency.acquire()
+            throttled = False
+            try:
+                result = func(*args, **kwargs)
+                response = result
+                throttled = is_throttled(response)
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                throttled = is_throttled(response)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+            finally:
+                self.concurrency.release(throttled)
+            if not throttled or attempt >= self.max_retries:
+                return result
+
+            attempt += 1
+            delay = get_retry_after(response) or backoff_delay(attempt, self.base_delay, self.max_delay)
+            if self.metrics:
+                self.metrics.incr('{}_throttled'.format(self.name))
+            self.print_func('{} throttled (status {}). Concurrency limit lowered to {:.1f}; retry {} of {} in {:.2f} seconds.'.format(
+                self.name, get_status_code(response), self.concurrency.limit, attempt, self.max_retries, delay))
+            time.sleep(delay)
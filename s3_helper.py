@@ -2,11 +2,46 @@
 AWS and AWS S3 Helper functions.
 
 """
-import boto3
-import botocore.exceptions
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from gzip import GzipFile
+from io import TextIOWrapper
 import json
 import logging
+import os
+import threading
+import time
 import traceback
+import zlib
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_READ_CHUNK_SIZE = 1024 * 1024
+# S3 requires every part of a multipart upload but the last to be at least 5 MB
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_INDEX_TTL = 60
+
+# Sessions and clients are cached at module level so that warm lambda
+# containers reuse them (and their keep-alive connections) across invocations.
+_session_cache = {}
+_client_cache = {}
+_cache_lock = threading.Lock()
+
+
+def invalidate_aws_cache():
+    """
+    Drop all cached AWS sessions and clients, e.g. after credentials rotate.
+    The next aws_helper created will establish a new session.
+
+    """
+    with _cache_lock:
+        _session_cache.clear()
+        _client_cache.clear()
 
 
 class aws_helper(object):
@@ -14,7 +49,7 @@ class aws_helper(object):
     Helper class for connecting to AWS.
 
     """
-    def __init__(self, aws_profile=None, logger=False):
+    def __init__(self, aws_profile=None, logger=False, pool_size=DEFAULT_POOL_SIZE):
         """
         Initialization function of the aws_helper class.
 
@@ -27,21 +62,51 @@ class aws_helper(object):
             logger: Optional parameter. Could pass in a logger object or not pass
                 in anything. If a logger object is passed in, information will be
                 logged instead of printed. If not, information will be printed.
+            pool_size: Maximum number of keep-alive connections each AWS client
+                created by this helper keeps open.
         """
         self.aws_profile = aws_profile
+        self.pool_size = pool_size
         self.print_func = print
         if logger:
             self.print_func = logger.info
         self.session = self._create_aws_session()
 
+    def get_client(self, service_name):
+        """
+        Get a client for an AWS service. Clients are cached per profile, service
+        and pool size, and reused across helper instances.
+
+        Parameters:
+            service_name: name of the AWS service (e.g. 's3', 'lambda')
+
+        Returns:
+            AWS client.
+        """
+        cache_key = (self.aws_profile, service_name, self.pool_size)
+        with _cache_lock:
+            if cache_key not in _client_cache:
+                import botocore.config
+                config = botocore.config.Config(max_pool_connections=self.pool_size,
+                                                tcp_keepalive=True)
+                _client_cache[cache_key] = self.session.client(service_name, config=config)
+            return _client_cache[cache_key]
+
     def _create_aws_session(self):
         """
         Creates AWS session using aws profile name passed in or using aws
-        credentials in environment variables.
+        credentials in environment variables. Sessions are cached per profile.
+        boto3 is imported here rather than at module level, since importing it
+        is a large part of a lambda cold start.
 
         Returns:
             AWS session object.
         """
+        import boto3
+        import botocore.exceptions
+        with _cache_lock:
+            if self.aws_profile in _session_cache:
+                return _session_cache[self.aws_profile]
         try:
             if self.aws_profile:
                 session = boto3.session.Session(profile_name=self.aws_profile, region_name='us-east-1')
@@ -54,6 +119,8 @@ class aws_helper(object):
             self.print_func(traceback.format_exc())
             self.print_func('Exiting. Unable to establish AWS session with the following profile name: {}'.format(self.aws_profile))
             exit()
+        with _cache_lock:
+            session = _session_cache.setdefault(self.aws_profile, session)
         return session
 
 
@@ -62,13 +129,22 @@ class S3Helper(aws_helper):
     Helper class for connecting to and working with AWS S3.
 
     """
-    def __init__(self, **kwargs):
+    def __init__(self, index_ttl=DEFAULT_INDEX_TTL, **kwargs):
         """
         Initialization function of the S3Helper class.
 
+        Parameters:
+            index_ttl: number of seconds the results of existence checks and
+                prefix listings are reused before S3 is asked again.
         """
         super(S3Helper, self).__init__(**kwargs)
         self.client = self._get_client()
+        self.err_lines = []
+        self.index_ttl = index_ttl
+        # (bucket, prefix) -> (time listed, {key: size})
+        self.prefix_index = {}
+        # (bucket, key) -> (time checked, size or None if the key does not exist)
+        self.key_index = {}
 
     def _get_client(self):
         """
@@ -77,11 +153,12 @@ class S3Helper(aws_helper):
         Returns:
             AWS S3 client.
         """
-        return self.session.client('s3')
+        return self.get_client('s3')
 
     def path_exists(self, bucket, path):
         """
-        Check if S3 path exists.
+        Check if S3 path exists, with a HEAD request (no object data is
+        transferred). Results are reused for index_ttl seconds.
 
         Parameters:
             bucket: name of S3 bucket
@@ -90,11 +167,109 @@ class S3Helper(aws_helper):
         Returns:
             Boolean (True/False)
         """
+        return self.get_size(bucket, path) is not None
+
+    def get_size(self, bucket, path):
+        """
+        Get the size of the object at an S3 path. Answered from a fresh prefix
+        listing covering the path if there is one, otherwise with a HEAD request.
+
+        Parameters:
+            bucket: name of S3 bucket
+            path: key of S3 path
+
+        Returns:
+            Size of the object in bytes, or None if it does not exist.
+        """
+        now = time.time()
+        for (index_bucket, prefix), (listed_at, sizes) in list(self.prefix_index.items()):
+            if index_bucket == bucket and path.startswith(prefix) and now - listed_at < self.index_ttl:
+                return sizes.get(path)
+        checked = self.key_index.get((bucket, path))
+        if checked and now - checked[0] < self.index_ttl:
+            return checked[1]
+
         try:
-            self.client.get_object(Bucket=bucket, Key=path)
-            return True
-        except self.client.exceptions.NoSuchKey:
-            return False
+            size = self.client.head_object(Bucket=bucket, Key=path)['ContentLength']
+        except self.client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+                raise
+            size = None
+        self.key_index[(bucket, path)] = (now, size)
+        return size
+
+    def list_prefix(self, bucket, prefix, refresh=False):
+        """
+        List all keys under a prefix, with one paginated list_objects_v2 scan.
+        The listing is reused for index_ttl seconds.
+
+        Parameters:
+            bucket: name of S3 bucket
+            prefix: key prefix to list
+            refresh: Boolean. If True, the prefix is listed again even if a
+                fresh listing exists.
+
+        Returns:
+            Dictionary object with the key as key and the object size in bytes
+            as value.
+        """
+        listed = self.prefix_index.get((bucket, prefix))
+        if listed and not refresh and time.time() - listed[0] < self.index_ttl:
+            return listed[1]
+        listed_at = time.time()
+        sizes = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                sizes[obj['Key']] = obj['Size']
+        self.prefix_index[(bucket, prefix)] = (listed_at, sizes)
+        return sizes
+
+    def paths_exist(self, bucket, paths, prefix=None):
+        """
+        Check existence and size of many S3 paths at once, with a single listing
+        of their common prefix instead of one request per path. If the paths do
+        not share a directory (a common prefix containing '/') and no prefix is
+        given, each path is checked on its own rather than listing the whole
+        bucket.
+
+        Parameters:
+            bucket: name of S3 bucket
+            paths: array of keys of S3 paths
+            prefix: Optional key prefix to list. Defaults to the longest prefix
+                common to all paths. Every path must start with it.
+
+        Returns:
+            Dictionary object with the path as key and the object size in bytes
+            (or None if it does not exist) as value.
+        """
+        paths = list(paths)
+        if not paths:
+            return {}
+        if prefix is None:
+            prefix = os.path.commonprefix(paths)
+            if '/' not in prefix:
+                return {path: self.get_size(bucket, path) for path in paths}
+        elif not prefix:
+            raise ValueError('An empty prefix would list the whole bucket {}.'.format(bucket))
+        elif not all(path.startswith(prefix) for path in paths):
+            raise ValueError('Not all paths start with the prefix {}.'.format(prefix))
+        sizes = self.list_prefix(bucket, prefix)
+        return {path: sizes.get(path) for path in paths}
+
+    def forget_path(self, bucket, path):
+        """
+        Drop cached existence information about an S3 path, e.g. after writing
+        to it.
+
+        Parameters:
+            bucket: name of S3 bucket
+            path: key of S3 path
+        """
+        self.key_index.pop((bucket, path), None)
+        for index_bucket, prefix in list(self.prefix_index):
+            if index_bucket == bucket and path.startswith(prefix):
+                self.prefix_index.pop((index_bucket, prefix), None)
 
     def get_data_stream(self, bucket, key):
         """
@@ -115,49 +290,126 @@ class S3Helper(aws_helper):
             data = obj['Body']._raw_stream
         return data
 
-    def newline_json_rec_generator(self, data_stream):
+    def iter_lines(self, data_stream, gzipped=False, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+        """
+        Reads a data stream in large chunks and returns it one line at a time.
+        Gzipped streams (including multi-member gzip files) are decompressed
+        incrementally, so memory use does not grow with the size of the stream.
+
+        Parameters:
+            data_stream: "Readable" file datastream objects, returning bytes or str
+            gzipped: Boolean. True if the stream is gzip compressed.
+            chunk_size: number of bytes read from the stream at a time
+
+        Returns:
+            Iterable array of lines, without the trailing newline
+        """
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if gzipped else None
+        leftover = None
+        while True:
+            data = data_stream.read(chunk_size)
+            if not data:
+                break
+            if decompressor:
+                out = decompressor.decompress(data)
+                while decompressor.unused_data:
+                    unused_data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    out += decompressor.decompress(unused_data)
+                data = out
+            if leftover:
+                data = leftover + data
+            lines = data.split(b'\n' if type(data) == bytes else '\n')
+            leftover = lines.pop()
+            for line in lines:
+                yield line
+        if leftover:
+            yield leftover
+
+    def newline_json_rec_generator(self, data_stream, gzipped=False, chunk_size=DEFAULT_READ_CHUNK_SIZE):
         """
         Receives a data stream that is assumed to be in the newline JSON format
         (one stringified json per line), reads and returns these records as
-        dictionary objects one at a time.
+        dictionary objects one at a time. The stream is read in large chunks, and
+        lines are parsed with orjson if it is installed. Invalid lines are
+        skipped and collected in `err_lines`.
 
         Parameters:
             data_stream: "Readable" file datastream objects
+            gzipped: Boolean. True if the stream is gzip compressed.
+            chunk_size: number of bytes read from the stream at a time
 
         Returns:
             Iterable array of dictionary objects
         """
-        line = data_stream.readline()
-        while line:
-            if type(line) == bytes:
-                line_stripped = line.strip(b'\n')
-            else:
-                line_stripped = line.strip('\n')
-
+        for line in self.iter_lines(data_stream, gzipped=gzipped, chunk_size=chunk_size):
+            if not line or line.isspace():
+                continue
             try:
-                if line_stripped:
-                    yield json.loads(line_stripped)
+                yield json_loads(line)
             except Exception as e:
                 self.print_func(traceback.format_exc())
                 self.print_func('Invalid json line. Skipping: {}'.format(line))
                 self.err_lines.append(line)
-            line = data_stream.readline()
 
-    def write_recs(self, recs, bucket, key):
+    def read_newline_json_recs(self, bucket, key, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+        """
+        Reads the newline json file at the specified S3 key in the specified S3
+        bucket, and returns its records as dictionary objects one at a time.
+        Keys ending in '.gz' are decompressed on the fly.
+
+        Parameters:
+            bucket: name of S3 bucket
+            key: key of S3 path
+            chunk_size: number of bytes read from S3 at a time
+
+        Returns:
+            Iterable array of dictionary objects
+        """
+        obj = self.client.get_object(Bucket=bucket, Key=key)
+        return self.newline_json_rec_generator(obj['Body'], gzipped=key[-3:] == '.gz', chunk_size=chunk_size)
+
+    def open_writer(self, bucket, key, gzipped=False, part_size=DEFAULT_PART_SIZE, max_workers=4):
+        """
+        Opens a streaming writer for a newline json file at the specified S3 key
+        in the specified S3 bucket. Use it as a context manager:
+
+            with s3helper.open_writer(bucket, key, gzipped=True) as writer:
+                for rec in recs:
+                    writer.write(rec)
+
+        Parameters:
+            bucket: name of S3 bucket
+            key: key of S3 path
+            gzipped: Boolean. If True, the file is gzip compressed on the fly.
+            part_size: number of bytes buffered before a part is uploaded
+            max_workers: maximum number of parts uploaded in parallel
+
+        Returns:
+            S3NewlineJsonWriter object
+        """
+        return S3NewlineJsonWriter(self.client, bucket, key, gzipped=gzipped, part_size=part_size,
+                                   max_workers=max_workers, print_func=self.print_func)
+
+    def write_recs(self, recs, bucket, key, gzipped=False):
         """
         Writes the array of dictionary objects as newline json text file to the
-        specified S3 key in the specified S3 bucket
+        specified S3 key in the specified S3 bucket. Records are streamed to S3
+        in multipart chunks, so recs can be any iterable and files larger than
+        the 5 GB single put limit can be written.
 
         Parameters:
             recs: array of dictionary objects
             bucket: name of S3 bucket
             path: key of S3 path
+            gzipped: Boolean. If True, the file is gzip compressed.
 
         Returns:
             None
         """
-        outbytes = "\n".join([json.dumps(i) for i in recs if i]).encode('utf-8')
-        self.client.put_object(Bucket=bucket, Key=key, Body=outbytes)
+        with self.open_writer(bucket, key, gzipped=gzipped) as writer:
+            writer.write_recs(recs)
+        self.forget_path(bucket, key)
 
     def write_bytes(self, outbytes, bucket, key):
         """
@@ -174,3 +426,149 @@ class S3Helper(aws_helper):
         if type(outbytes) != bytes:
             outbytes = outbytes.encode('utf-8')
         self.client.put_object(Bucket=bucket, Key=key, Body=outbytes)
+        self.forget_path(bucket, key)
+
+
+class S3NewlineJsonWriter(object):
+    """
+    Streaming writer of newline json files to S3. Records are serialized (and
+    optionally gzip compressed) as they are written, and uploaded as multipart
+    upload parts in parallel once part_size bytes have been buffered, so memory
+    use is bounded by about (max_workers + 1) * part_size. Files smaller than
+    one part are written with a single put_object.
+
+    """
+    def __init__(self, client, bucket, key, gzipped=False, part_size=DEFAULT_PART_SIZE, max_workers=4, print_func=print):
+        """
+        Initialization function of the S3NewlineJsonWriter class.
+
+        Parameters:
+            client: AWS S3 client
+            bucket: name of S3 bucket
+            key: key of S3 path
+            gzipped: Boolean. If True, the file is gzip compressed on the fly.
+            part_size: number of bytes buffered before a part is uploaded
+            max_workers: maximum number of parts uploaded in parallel
+            print_func: function used to log information
+        """
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.print_func = print_func
+        self.compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if gzipped else None
+
+        self.buffer = []
+        self.buffer_size = 0
+        self.n_recs = 0
+        self.upload_id = None
+        self.parts = []
+        self.in_flight = {}
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, rec):
+        """
+        Writes one dictionary object as a line of the file. Empty records are
+        skipped.
+
+        Parameters:
+            rec: dictionary object
+        """
+        if not rec:
+            return
+        line = json.dumps(rec)
+        if self.n_recs:
+            line = '\n' + line
+        self.n_recs += 1
+        self._buffer(line.encode('utf-8'))
+
+    def write_recs(self, recs):
+        """
+        Writes each dictionary object of an iterable as a line of the file.
+
+        Parameters:
+            recs: iterable of dictionary objects
+        """
+        for rec in recs:
+            self.write(rec)
+
+    def _buffer(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        if data:
+            self.buffer.append(data)
+            self.buffer_size += len(data)
+        if self.buffer_size >= self.part_size:
+            self._upload_part()
+
+    def _take_buffer(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        return data
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = response['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        if len(self.in_flight) >= self.max_workers:
+            done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        part_number = len(self.parts) + len(self.in_flight) + 1
+        future = self.executor.submit(self.client.upload_part, Bucket=self.bucket, Key=self.key,
+                                      UploadId=self.upload_id, PartNumber=part_number,
+                                      Body=self._take_buffer())
+        self.in_flight[future] = part_number
+
+    def _collect(self, futures):
+        for future in futures:
+            part_number = self.in_flight.pop(future)
+            self.parts.append({'ETag': future.result()['ETag'], 'PartNumber': part_number})
+
+    def close(self):
+        """
+        Flushes the remaining buffered data and completes the upload.
+
+        """
+        if self.compressor:
+            self.buffer.append(self.compressor.flush())
+            self.compressor = None
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=self._take_buffer())
+            return
+        try:
+            self._upload_part()
+            self._collect(list(self.in_flight))
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': sorted(self.parts, key=lambda x: x['PartNumber'])})
+        except Exception:
+            self.abort()
+            raise
+        self.executor.shutdown()
+
+    def abort(self):
+        """
+        Aborts the upload, discarding any parts already uploaded.
+
+        """
+        if self.upload_id is None:
+            return
+        if self.executor:
+            self.executor.shutdown()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Unable to abort multipart upload of s3://{}/{}'.format(self.bucket, self.key))
@@ -2,14 +2,192 @@
 Helper class for interacting with datasets in Socrata.
 
 """
-import boto3
-import copy
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import itertools
 import json
-import os
 import requests
+import requests.adapters
 from sodapy import Socrata
+import threading
 import time
+import traceback
+
+from metrics import Metrics
+from rate_limit import RateLimiter, backoff_delay
+from s3_helper import S3Helper
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_METADATA_TTL = 3600
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_DRAFT_TIMEOUT = 120
+
+# Socrata clients and HTTP sessions are cached at module level so that warm
+# lambda containers reuse them (and their keep-alive connections) across
+# invocations.
+_socrata_client_cache = {}
+_http_session_cache = {}
+_cache_lock = threading.Lock()
+
+# Column metadata per (domain, dataset_id). Each entry holds the column data type
+# dictionary, the ETag it was served with and the time it was last validated.
+_metadata_cache = {}
+
+
+def _mount_pool(session, pool_size):
+    """
+    Mount a keep-alive connection pool of the given size on a requests session.
+
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def get_socrata_client(socrata_params, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Get a sodapy Socrata client for the credentials given. Clients are cached
+    per set of credentials and pool size.
+
+    Parameters:
+        socrata_params: Dictionary object containing Socrata credentials.
+        pool_size: Maximum number of keep-alive connections to keep open.
+
+    Returns:
+        sodapy.Socrata object.
+    """
+    cache_key = (json.dumps(socrata_params, sort_keys=True), pool_size)
+    with _cache_lock:
+        if cache_key not in _socrata_client_cache:
+            client = Socrata(**socrata_params)
+            _mount_pool(client.session, pool_size)
+            _socrata_client_cache[cache_key] = client
+        return _socrata_client_cache[cache_key]
+
+
+def get_http_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Get a requests session with a keep-alive connection pool of the given size.
+
+    Parameters:
+        pool_size: Maximum number of keep-alive connections to keep open.
+
+    Returns:
+        requests.Session object.
+    """
+    with _cache_lock:
+        if pool_size not in _http_session_cache:
+            session = requests.Session()
+            _mount_pool(session, pool_size)
+            _http_session_cache[pool_size] = session
+        return _http_session_cache[pool_size]
+
+
+def invalidate_socrata_cache():
+    """
+    Close and drop all cached Socrata clients and HTTP sessions, e.g. after
+    credentials rotate. Cached column metadata is dropped as well.
+
+    """
+    with _cache_lock:
+        _metadata_cache.clear()
+        for client in _socrata_client_cache.values():
+            client.close()
+        for session in _http_session_cache.values():
+            session.close()
+        _socrata_client_cache.clear()
+        _http_session_cache.clear()
+
+
+def chunked(iterable, chunk_size):
+    """
+    Split an iterable into arrays of at most chunk_size items, without reading
+    more than one chunk ahead.
+
+    Parameters:
+        iterable: any iterable, e.g. a generator of records.
+        chunk_size: maximum number of items per chunk.
+
+    Returns:
+        Generator of arrays.
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+def poll_until(check, timeout, initial_delay=0.25, max_delay=8):
+    """
+    Call `check` until it returns a truthy value, waiting between calls with a
+    delay that doubles from initial_delay up to max_delay.
+
+    Parameters:
+        check: function taking no arguments
+        timeout: maximum number of seconds to keep polling
+        initial_delay: seconds to wait after the first unsuccessful call
+        max_delay: maximum number of seconds to wait between calls
+
+    Returns:
+        The first truthy value returned by `check`, or None on timeout.
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def build_coercer(col_dtype_dict, float_fields=None):
+    """
+    Build a function that coerces batches of records to the data types of a
+    Socrata data set. Equivalent to calling SocrataDataset.mod_dtype on each
+    record, but the per-field dispatch is resolved once per schema instead of
+    once per field of every record.
+
+    Parameters:
+        col_dtype_dict: data dictionary of a Socrata data set in the form of a dictionary,
+        with the key being the column name and the value being the column data type
+        float_fields: list of fields that should be a float
+
+    Returns:
+        Function that takes an iterable of dictionary objects and returns an
+        array of the coerced dictionary objects.
+    """
+    float_fields = set(float_fields or [])
+    dtype_func = {'number': float, 'text': str, 'checkbox': bool}
+    # column name -> (conversion function or None, whether the field is always cast to float)
+    converters = {}
+    for col, dtype in col_dtype_dict.items():
+        if col in float_fields:
+            converters[col] = (float, True)
+        else:
+            converters[col] = (dtype_func.get(dtype), False)
+
+    def coerce_rec(rec):
+        out = {}
+        for k, v in rec.items():
+            converter = converters.get(k)
+            if converter is None:
+                continue
+            func, forced = converter
+            if forced:
+                out[k] = float(v)
+            elif v is not None and v != '':
+                out[k] = func(v) if func else v
+        return out
+
+    def coerce(recs):
+        return [coerce_rec(rec) for rec in recs]
+
+    return coerce
 
 
 class SocrataDataset(object):
@@ -18,7 +196,9 @@ class SocrataDataset(object):
 
     """
     logger=None
-    def __init__(self, dataset_id, socrata_client=None, socrata_params=None, float_fields=None, logger=None):
+    def __init__(self, dataset_id, socrata_client=None, socrata_params=None, float_fields=None, logger=None,
+                 pool_size=DEFAULT_POOL_SIZE, lazy_metadata=False, metadata_ttl=DEFAULT_METADATA_TTL,
+                 metadata_cache_bucket=None, metadata_cache_key=None, metrics=None, rate_limit=None):
         """
         Initialization function of the SocrataDataset class.
 
@@ -37,32 +217,163 @@ class SocrataDataset(object):
             logger: Optional parameter. Could pass in a logger object or not pass
                 in anything. If a logger object is passed in, information will be
                 logged instead of printed. If not, information will be printed.
+            pool_size: Maximum number of keep-alive HTTP connections kept open
+                to Socrata.
+            lazy_metadata: Optional boolean. If True, the dataset's column
+                metadata is only fetched the first time it is needed (e.g. by
+                mod_dtype) instead of on initialization.
+            metadata_ttl: Number of seconds cached column metadata is used
+                before it is revalidated against Socrata.
+            metadata_cache_bucket: Optional name of an S3 bucket in which to
+                persist the column metadata cache between processes.
+            metadata_cache_key: Optional S3 key of the persisted column metadata
+                cache. Required if metadata_cache_bucket is given.
+            metrics: Optional Metrics object in which to record timings and
+                counts of Socrata calls. A new one is created if not given.
+            rate_limit: Optional maximum number of Socrata requests per second.
+                Whether or not it is given, concurrent requests are limited to
+                pool_size, the limit is lowered when Socrata throttles (HTTP 429)
+                and throttled requests are retried with jittered backoff.
         """
         self.socrata_params={}
         self.float_fields=[]
         self.dataset_id = dataset_id
+        self.pool_size = pool_size
         self.client = socrata_client
         if not socrata_client and socrata_params:
-            self.client = Socrata(**socrata_params)
+            self.client = get_socrata_client(socrata_params, pool_size)
+        self.http_session = get_http_session(pool_size)
         self.socrata_params = socrata_params
-        self.col_dtype_dict = self.get_col_dtype_dict()
         self.float_fields = float_fields
         self.print_func = print
         if logger:
             self.print_func = logger.info
+        self.metadata_ttl = metadata_ttl
+        self.metadata_cache_bucket = metadata_cache_bucket
+        self.metadata_cache_key = metadata_cache_key
+        self.metadata_s3 = None
+        self.coercer = None
+        self.coercer_schema = None
+        # metadata cache entry last fetched by this instance
+        self.col_dtype_entry = None
+        # data dictionary assigned by the caller, used instead of the cache
+        self.col_dtype_override = None
+        self.metrics = metrics or Metrics(dimensions={'DatasetId': dataset_id})
+        self.rate_limiter = RateLimiter('socrata', rate=rate_limit, max_concurrency=pool_size,
+                                        print_func=self.print_func, metrics=self.metrics)
+        if not lazy_metadata:
+            self.get_col_dtype_dict()
+
+    @property
+    def col_dtype_dict(self):
+        """
+        Data dictionary of the Socrata data set, fetched on first use and
+        revalidated once it is older than `metadata_ttl`. Between fetches the
+        dictionary is served from the instance without going through
+        get_col_dtype_dict, so per-record callers do not count as cache hits.
+        A dictionary assigned to it is used as is until None is assigned.
+
+        """
+        if self.col_dtype_override is not None:
+            return self.col_dtype_override
+        entry = self.col_dtype_entry
+        if (entry is not None and entry is _metadata_cache.get((self.client.domain, self.dataset_id))
+                and time.time() - entry['validated_at'] < self.metadata_ttl):
+            return entry['col_dtype_dict']
+        return self.get_col_dtype_dict()
+
+    @col_dtype_dict.setter
+    def col_dtype_dict(self, col_dtype_dict):
+        self.col_dtype_override = col_dtype_dict
 
     def get_col_dtype_dict(self):
         """
         Retrieve data dictionary of a Socrata data set in the form of a dictionary,
         with the key being the column name and the value being the column data type
 
+        The result is cached in process (and in S3, if a metadata cache bucket
+        was given) for `metadata_ttl` seconds. Once expired, the metadata is
+        revalidated with a conditional request, so it is only downloaded again
+        if the dataset's schema has changed.
+
     	Returns:
     		Data dictionary of a Socrata data set in the form of a dictionary,
             with the key being the column name and the value being the column data type.
         """
-        dataset_col_meta = self.client.get_metadata(self.dataset_id)['columns']
-        col_dtype_dict = {col['name']: col['dataTypeName'] for col in dataset_col_meta}
-        return col_dtype_dict
+        cache_key = (self.client.domain, self.dataset_id)
+        entry = _metadata_cache.get(cache_key)
+        if entry is None and self.metadata_cache_bucket:
+            entry = self._read_metadata_s3_cache()
+        if entry and time.time() - entry['validated_at'] < self.metadata_ttl:
+            _metadata_cache[cache_key] = entry
+            self.col_dtype_entry = entry
+            self.metrics.incr('metadata_cache_hits')
+            return entry['col_dtype_dict']
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        with self.metrics.timer('get_col_dtype_dict'):
+            response = self.rate_limiter.call(self.client.session.get,
+                                              'https://{}/api/views/{}.json'.format(self.client.domain, self.dataset_id),
+                                              headers=headers, timeout=self.client.timeout)
+        if response.status_code == 304:
+            self.metrics.incr('metadata_revalidated')
+            entry = dict(entry, validated_at=time.time())
+        else:
+            response.raise_for_status()
+            dataset_col_meta = response.json()['columns']
+            entry = {
+                'col_dtype_dict': {col['name']: col['dataTypeName'] for col in dataset_col_meta},
+                'etag': response.headers.get('ETag'),
+                'validated_at': time.time()
+            }
+        _metadata_cache[cache_key] = entry
+        self.col_dtype_entry = entry
+        if self.metadata_cache_bucket:
+            self._write_metadata_s3_cache(entry)
+        return entry['col_dtype_dict']
+
+    def _get_metadata_s3(self):
+        """
+        Get the S3Helper used for the persisted column metadata cache.
+
+        """
+        if self.metadata_s3 is None:
+            self.metadata_s3 = S3Helper()
+        return self.metadata_s3
+
+    def _read_metadata_s3_cache(self):
+        """
+        Read the persisted column metadata cache entry from S3.
+
+        Returns:
+            Cache entry dictionary, or None if it does not exist or cannot be read.
+        """
+        try:
+            s3 = self._get_metadata_s3()
+            if not s3.path_exists(self.metadata_cache_bucket, self.metadata_cache_key):
+                return None
+            data_stream = s3.get_data_stream(self.metadata_cache_bucket, self.metadata_cache_key)
+            return json.loads(data_stream.read())
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Unable to read metadata cache from s3://{}/{}'.format(self.metadata_cache_bucket, self.metadata_cache_key))
+            return None
+
+    def _write_metadata_s3_cache(self, entry):
+        """
+        Persist a column metadata cache entry to S3. Failures are logged and
+        otherwise ignored, since the cache is only an optimization.
+
+        Parameters:
+            entry: Cache entry dictionary.
+        """
+        try:
+            self._get_metadata_s3().write_bytes(json.dumps(entry), self.metadata_cache_bucket, self.metadata_cache_key)
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Unable to write metadata cache to s3://{}/{}'.format(self.metadata_cache_bucket, self.metadata_cache_key))
 
     def mod_dtype(self, rec, col_dtype_dict=None, float_fields=None):
         """
@@ -79,8 +390,9 @@ class SocrataDataset(object):
     		Dictionary object of the data record, with number, string, and boolean fields
             modified to align with the data type of the corresponding Socrata data set.
         """
-        col_dtype_dict = col_dtype_dict or self.col_dtype_dict
-        float_fields = float_fields or self.float_fields
+        if col_dtype_dict is None:
+            col_dtype_dict = self.col_dtype_dict
+        float_fields = float_fields or self.float_fields or []
 
         identity = lambda x: x
         dtype_func = {'number': float, 'text': str, 'checkbox': bool}
@@ -93,6 +405,31 @@ class SocrataDataset(object):
         out = {k:v for k,v in out.items() if k in col_dtype_dict}
         return out
 
+    def mod_dtype_batch(self, recs, col_dtype_dict=None, float_fields=None):
+        """
+        Same as mod_dtype, for an array of data records at once. Uses a coercer
+        compiled once per schema and reused until the schema changes.
+
+    	Parameters:
+    		recs: array of dictionary objects of the data records
+            col_dtype_dict: data dictionary of a Socrata data set in the form of a dictionary,
+            with the key being the column name and the value being the column data type
+            float_fields: list of fields that should be a float
+
+    	Returns:
+    		Array of dictionary objects of the data records, with number, string, and boolean fields
+            modified to align with the data type of the corresponding Socrata data set.
+        """
+        if col_dtype_dict is None:
+            col_dtype_dict = self.col_dtype_dict
+        float_fields = float_fields or self.float_fields or []
+
+        if (self.coercer is None or self.coercer_schema[0] is not col_dtype_dict
+                or self.coercer_schema[1] != tuple(float_fields)):
+            self.coercer = build_coercer(col_dtype_dict, float_fields)
+            self.coercer_schema = (col_dtype_dict, tuple(float_fields))
+        return self.coercer(recs)
+
     def create_new_draft(self):
         """
         Create a new draft of the current dataset.
@@ -100,62 +437,255 @@ class SocrataDataset(object):
         Returns:
             Draft ID of the new draft.
         """
-        draft_dataset = requests.post('https://{}/api/views/{}/publication.json'.format(self.client.domain, self.dataset_id),
-                                  auth=(self.socrata_params['username'], self.socrata_params['password']),
-                                  params={'method': 'copySchema'})
-        logger.info(draft_dataset.json())
+        draft_dataset = self.rate_limiter.call(self.http_session.post,
+                                               'https://{}/api/views/{}/publication.json'.format(self.client.domain, self.dataset_id),
+                                               auth=(self.socrata_params['username'], self.socrata_params['password']),
+                                               params={'method': 'copySchema'}, timeout=self.client.timeout)
+        self.print_func(draft_dataset.json())
         draft_id = draft_dataset.json()['id']
         return draft_id
 
-    def publish_draft(self, draft_id):
+    def is_draft_ready(self, draft_id):
+        """
+        Check if the Socrata draft specified can be acted on, i.e. its metadata
+        can be read.
+
+        Parameters:
+            draft_id: 4x4 ID of the Socrata draft (e.g. x123-bc12)
+
+        Returns:
+            Boolean (True/False)
+        """
+        response = self.rate_limiter.call(self.http_session.get,
+                                          'https://{}/api/views/{}.json'.format(self.client.domain, draft_id),
+                                          auth=(self.socrata_params['username'], self.socrata_params['password']),
+                                          timeout=self.client.timeout)
+        return response.status_code == 200
+
+    def wait_for_draft(self, draft_id, timeout=DEFAULT_DRAFT_TIMEOUT):
         """
-        Publish the Socrata draft specified.
+        Wait until the Socrata draft specified is ready, polling its status with
+        increasing delays instead of sleeping for a fixed time.
 
         Parameters:
             draft_id: 4x4 ID of the Socrata draft (e.g. x123-bc12)
+            timeout: maximum number of seconds to wait
+
+        Returns:
+            Boolean (True/False) indicating if the draft became ready in time.
+        """
+        with self.metrics.timer('wait_for_draft'):
+            ready = poll_until(lambda: self.is_draft_ready(draft_id), timeout)
+        if not ready:
+            self.print_func('Draft {} not ready after {} seconds.'.format(draft_id, timeout))
+        return bool(ready)
+
+    def publish_draft(self, draft_id, timeout=DEFAULT_DRAFT_TIMEOUT, wait=True):
+        """
+        Publish the Socrata draft specified, as soon as it is ready. While
+        Socrata is still processing the draft it answers with 202, in which case
+        the request is repeated with increasing delays until timeout.
+
+        Parameters:
+            draft_id: 4x4 ID of the Socrata draft (e.g. x123-bc12)
+            timeout: maximum number of seconds to wait for the draft
+            wait: Boolean. If False, the draft is taken to be ready already
+                (e.g. after wait_for_draft) and is not checked again.
 
         Returns:
             Response of the publish draft request.
         """
-        time.sleep(5)
-        publish_response = requests.post('https://{}/api/views/{}/publication.json'.format(self.client.domain, draft_id),
-                                        auth=(self.socrata_params['username'], self.socrata_params['password']))
-        logger.info(publish_response.json())
+        deadline = time.time() + timeout
+        if wait and not self.wait_for_draft(draft_id, timeout):
+            raise Exception('Draft {} not ready after {} seconds. Not publishing it.'.format(draft_id, timeout))
+        responses = []
+
+        def publish():
+            with self.metrics.timer('publish_draft'):
+                response = self.rate_limiter.call(self.http_session.post,
+                                                  'https://{}/api/views/{}/publication.json'.format(self.client.domain, draft_id),
+                                                  auth=(self.socrata_params['username'], self.socrata_params['password']),
+                                                  timeout=self.client.timeout)
+            responses.append(response)
+            return response.status_code != 202
+
+        poll_until(publish, max(0, deadline - time.time()))
+        publish_response = responses[-1]
+        self.print_func(publish_response.json())
         return publish_response
 
-    def delete_draft(self, draft_id):
+    def delete_draft(self, draft_id, timeout=DEFAULT_DRAFT_TIMEOUT):
         """
-        Delete the Socrata draft specified.
+        Delete the Socrata draft specified, as soon as it is ready.
 
         Parameters:
             draft_id: 4x4 ID of the Socrata draft (e.g. x123-bc12)
+            timeout: maximum number of seconds to wait for the draft
 
         Returns:
             Response of the delete draft request.
         """
-        time.sleep(5)
-        delete_response = self.client.delete(draft_id)
+        self.wait_for_draft(draft_id, timeout)
+        delete_response = self.rate_limiter.call(self.client.delete, draft_id)
         if delete_response.status_code == 200:
-            logger.info('Empty draft {} has been discarded.'.format(draft_id))
+            self.print_func('Empty draft {} has been discarded.'.format(draft_id))
         return delete_response
 
-    def clean_and_upsert(self, recs, dataset_id=None):
+    def replace_dataset(self, recs, chunk_size=DEFAULT_CHUNK_SIZE, max_workers=1, max_retries=3,
+                        timeout=DEFAULT_DRAFT_TIMEOUT):
+        """
+        Replace all rows of the dataset: create a new draft, stream the records
+        into it and publish it. If any step fails the draft is deleted, leaving
+        the published dataset untouched.
+
+        Parameters:
+            recs: an iterable of dictionary objects of the data to publish.
+            chunk_size: maximum number of records sent per upsert request.
+            max_workers: maximum number of upsert requests in flight at once.
+            max_retries: number of times a failed chunk is retried.
+            timeout: maximum number of seconds to wait for the draft to be
+                ready, and then to be published.
+
+        Returns:
+            The upload totals, as returned by clean_and_upsert.
+        """
+        draft_id = self.create_new_draft()
+        try:
+            if not self.wait_for_draft(draft_id, timeout):
+                raise Exception('Draft {} not ready after {} seconds.'.format(draft_id, timeout))
+            totals = self.clean_and_upsert(recs, dataset_id=draft_id, chunk_size=chunk_size,
+                                           max_workers=max_workers, max_retries=max_retries)
+            if totals['Rows Failed']:
+                raise Exception('{} rows failed to upload to draft {}.'.format(totals['Rows Failed'], draft_id))
+            publish_response = self.publish_draft(draft_id, timeout, wait=False)
+            if publish_response.status_code != 200:
+                raise Exception('Publishing draft {} failed with status {}.'.format(draft_id, publish_response.status_code))
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Unable to replace dataset {}. Discarding draft {}.'.format(self.dataset_id, draft_id))
+            try:
+                self.delete_draft(draft_id, timeout)
+            except Exception:
+                # keep the original error, which is re-raised below
+                self.print_func(traceback.format_exc())
+                self.print_func('Unable to discard draft {}. It needs to be deleted manually.'.format(draft_id))
+            raise
+        return totals
+
+    def clean_and_upsert(self, recs, dataset_id=None, chunk_size=DEFAULT_CHUNK_SIZE, max_workers=1, max_retries=3):
         """
-        Publish the Socrata draft specified.
+        Coerce records to the data types of the Socrata data set and upsert them.
+        Records are read, coerced and uploaded in chunks, so any iterable
+        (e.g. the output of S3Helper.newline_json_rec_generator) can be passed
+        in without holding all records in memory.
 
         Parameters:
-            recs: an array of dictionary objects of the data to upsert.
+            recs: an iterable of dictionary objects of the data to upsert.
             dataset_id: 4x4 ID of the Socrata dataset (e.g. x123-bc12) to perform
             upserts to. This parameter is not required if you are performing upserts to the
             dataset you've initialized this class with.
+            chunk_size: maximum number of records sent per upsert request.
+            max_workers: maximum number of upsert requests in flight at once.
+            max_retries: number of times a failed chunk is retried.
 
         Returns:
-            A dictionary object with the following fields:
+            A dictionary object with the following fields, summed across chunks:
             'Rows Deleted' - number of rows deleted due to the upsert request
             'Rows Updated' - number of rows updated due to the upsert request
             'Rows Created' - number of rows created due to the upsert request
+            'Errors' - number of rows Socrata reported errors for
+            'Rows Failed' - number of rows in chunks that still failed after all
+                retries, plus the rows Socrata reported errors for
+        """
+        with self.metrics.timer('clean_and_upsert'):
+            totals, failed_recs, _ = self.upsert_in_chunks(recs, dataset_id=dataset_id,
+                                                           chunk_size=chunk_size,
+                                                           max_retries=max_retries,
+                                                           max_workers=max_workers,
+                                                           transform=self.mod_dtype_batch)
+        totals['Rows Failed'] = len(failed_recs) + totals['Errors']
+        if failed_recs:
+            self.print_func('{} rows failed to upsert after {} retries.'.format(len(failed_recs), max_retries))
+        if totals['Errors']:
+            self.print_func('Socrata reported errors for {} rows.'.format(totals['Errors']))
+        return totals
+
+    def upsert_in_chunks(self, recs, dataset_id=None, chunk_size=DEFAULT_CHUNK_SIZE, max_retries=3, retry_delay=1,
+                         max_workers=1, transform=None):
+        """
+        Upsert records in chunks of fixed size, with up to max_workers chunks in
+        flight at once. Chunks whose request raises are retried with jittered
+        exponential backoff; chunks that get a response are never resent.
+        Throttled requests are retried by the rate limiter and do not count as
+        failed attempts. A response reporting errors for some rows is final,
+        since the errors come from the data and the rows that were accepted are
+        already stored. Only the chunks in flight are held in memory.
+
+        Parameters:
+            recs: an iterable of dictionary objects of the data to upsert.
+            dataset_id: 4x4 ID of the Socrata dataset (e.g. x123-bc12) to perform
+            upserts to. This parameter is not required if you are performing upserts to the
+            dataset you've initialized this class with.
+            chunk_size: maximum number of records sent per upsert request.
+            max_retries: number of times a failed chunk is retried.
+            retry_delay: upper bound in seconds of the jittered wait before the
+            first retry. Doubles on each following retry.
+            max_workers: maximum number of upsert requests in flight at once.
+            transform: Optional function applied to each chunk before it is
+            uploaded, e.g. mod_dtype_batch.
+
+        Returns:
+            A tuple of (totals, failed_recs, partial_recs). totals is a
+            dictionary object with the 'Rows Deleted', 'Rows Updated', 'Rows
+            Created' and 'Errors' counts summed across all responses.
+            failed_recs is an array of the records from chunks that still raised
+            after all retries, none of which were stored. partial_recs is an
+            array of the records from chunks Socrata reported errors for, some
+            of which may have been stored.
         """
         dataset_id = dataset_id or self.dataset_id
-        out_recs = [self.mod_dtype(r) for r in recs]
-        upload_response = self.client.upsert(dataset_id, out_recs)
-        return upload_response
+        totals = {'Rows Deleted': 0, 'Rows Updated': 0, 'Rows Created': 0, 'Errors': 0}
+        failed_recs = []
+        partial_recs = []
+
+        def upload(idx, chunk):
+            out_chunk = transform(chunk) if transform else chunk
+            for attempt in range(max_retries + 1):
+                if attempt:
+                    self.metrics.incr('upsert_retries')
+                    time.sleep(backoff_delay(attempt, retry_delay))
+                try:
+                    with self.metrics.timer('upsert_chunk'):
+                        response = self.rate_limiter.call(self.client.upsert, dataset_id, out_chunk)
+                except Exception:
+                    self.print_func(traceback.format_exc())
+                    self.print_func('Upsert of chunk {} ({} records) failed on attempt {}.'.format(idx+1, len(chunk), attempt+1))
+                    continue
+                if not response.get('Errors'):
+                    return response, 'success'
+                self.print_func('Socrata reported {} errors for chunk {} ({} records).'.format(
+                    response['Errors'], idx+1, len(chunk)))
+                return response, 'partial'
+            return None, 'failed'
+
+        def collect(futures):
+            for future in futures:
+                chunk = in_flight.pop(future)
+                response, status = future.result()
+                if response is not None:
+                    for k in totals:
+                        totals[k] += response.get(k, 0)
+                if status == 'failed':
+                    failed_recs.extend(chunk)
+                elif status == 'partial':
+                    partial_recs.extend(chunk)
+
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for idx, chunk in enumerate(chunked(recs, chunk_size)):
+                if len(in_flight) >= max_workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[executor.submit(upload, idx, chunk)] = chunk
+            collect(list(in_flight))
+        return totals, failed_recs, partial_recs
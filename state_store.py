@@ -0,0 +1,313 @@
+"""
+Stores for the per-feed trigger state (last trigger time and run lease), so that
+scheduling decisions do not depend on reading timestamps back from Socrata and
+overlapping runs do not trigger the same feed twice.
+
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from feed_scheduler import parse_timestamp
+from s3_helper import S3Helper
+
+
+# Number of feed IDs per SQLite IN (...) query, below SQLite's variable limit
+SQLITE_QUERY_CHUNK_SIZE = 500
+
+# S3 error codes returned when a conditional write loses a race
+S3_CONFLICT_ERROR_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+# S3 error codes returned when reading a missing object without s3:ListBucket
+S3_ACCESS_DENIED_ERROR_CODES = ('AccessDenied', '403')
+
+
+def new_state():
+    """
+    State of a feed that has never been triggered or leased.
+
+    Returns:
+        Dictionary object.
+    """
+    return {'last_trigger_time': None, 'last_trigger_epoch': None, 'lease_owner': None, 'lease_expires': None}
+
+
+class StateStore(object):
+    """
+    Base class of the feed state stores. The state of each feed is a dictionary
+    object with the following fields:
+        'last_trigger_time' - ISO formatted time the feed was last triggered
+        'last_trigger_epoch' - the same time as an epoch
+        'lease_owner' - ID of the run currently triggering the feed, if any
+        'lease_expires' - epoch time the lease of that run expires
+
+    Subclasses implement `get_states` and `_update`.
+
+    """
+    def get_states(self, feed_ids=None):
+        """
+        Read the state of feeds.
+
+        Parameters:
+            feed_ids: Optional array of feed IDs. All feeds are read if not given.
+
+        Returns:
+            Dictionary object with the feed ID as key and its state as value.
+            Feeds without state are left out.
+        """
+        raise NotImplementedError
+
+    def _update(self, feed_ids, func):
+        """
+        Atomically read the state of feeds, pass it to `func` to modify in
+        place, and write it back. `func` may be called more than once if the
+        update has to be retried.
+
+        Parameters:
+            feed_ids: array of feed IDs to read.
+            func: function taking a dictionary object of feed ID to state.
+        """
+        raise NotImplementedError
+
+    def claim(self, feeds, owner, lease_seconds, now=None):
+        """
+        Take a lease on each feed that is not leased by another run and has not
+        been triggered since the given time. Only feeds that were claimed should
+        be triggered.
+
+        Parameters:
+            feeds: dictionary object with the feed ID as key and the epoch time
+                the caller last saw the feed triggered (None if never) as value.
+            owner: ID of the claiming run.
+            lease_seconds: number of seconds the lease is held before other runs
+                may claim the feed again.
+            now: Optional epoch time. Defaults to the current time.
+
+        Returns:
+            Array of the claimed feed IDs.
+        """
+        now = now or time.time()
+        claimed = []
+
+        def apply(states):
+            del claimed[:]
+            for feed_id, seen_epoch in feeds.items():
+                state = states.setdefault(feed_id, new_state())
+                if state['lease_owner'] not in (None, owner) and state['lease_expires'] > now:
+                    continue
+                if state['last_trigger_epoch'] is not None and (seen_epoch is None or state['last_trigger_epoch'] > seen_epoch):
+                    continue
+                state['lease_owner'] = owner
+                state['lease_expires'] = now + lease_seconds
+                claimed.append(feed_id)
+
+        self._update(list(feeds), apply)
+        return list(claimed)
+
+    def complete(self, triggered, owner):
+        """
+        Record the trigger time of feeds and release the leases of `owner` on
+        them.
+
+        Parameters:
+            triggered: dictionary object with the feed ID as key and the ISO
+                formatted trigger time as value.
+            owner: ID of the run that triggered the feeds.
+        """
+        epochs = {feed_id: parse_timestamp(trigger_time).timestamp() for feed_id, trigger_time in triggered.items()}
+
+        def apply(states):
+            for feed_id, trigger_time in triggered.items():
+                state = states.setdefault(feed_id, new_state())
+                if state['last_trigger_epoch'] is None or epochs[feed_id] > state['last_trigger_epoch']:
+                    state['last_trigger_time'] = trigger_time
+                    state['last_trigger_epoch'] = epochs[feed_id]
+                if state['lease_owner'] == owner:
+                    state['lease_owner'] = state['lease_expires'] = None
+
+        if triggered:
+            self._update(list(triggered), apply)
+
+    def release(self, feed_ids, owner):
+        """
+        Release the leases of `owner` on feeds without recording a trigger,
+        e.g. because triggering failed.
+
+        Parameters:
+            feed_ids: array of feed IDs.
+            owner: ID of the run holding the leases.
+        """
+        def apply(states):
+            for feed_id in feed_ids:
+                state = states.get(feed_id)
+                if state and state['lease_owner'] == owner:
+                    state['lease_owner'] = state['lease_expires'] = None
+
+        if feed_ids:
+            self._update(list(feed_ids), apply)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Feed state store in a local SQLite database file, for runs on the same host
+    (e.g. the daemon). Updates run in `BEGIN IMMEDIATE` transactions, so
+    processes sharing the file are serialized.
+
+    """
+    def __init__(self, path, timeout=30):
+        """
+        Initialization function of the SQLiteStateStore class.
+
+        Parameters:
+            path: path of the SQLite database file. Created if it does not exist.
+            timeout: number of seconds to wait for another process's transaction.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS feed_state ('
+                          'feed_id TEXT PRIMARY KEY, last_trigger_time TEXT, last_trigger_epoch REAL, '
+                          'lease_owner TEXT, lease_expires REAL)')
+
+    def _select(self, feed_ids=None):
+        columns = 'feed_id, last_trigger_time, last_trigger_epoch, lease_owner, lease_expires'
+        if feed_ids is None:
+            rows = self.conn.execute('SELECT {} FROM feed_state'.format(columns)).fetchall()
+        else:
+            feed_ids = list(feed_ids)
+            rows = []
+            for i in range(0, len(feed_ids), SQLITE_QUERY_CHUNK_SIZE):
+                chunk = feed_ids[i:i+SQLITE_QUERY_CHUNK_SIZE]
+                rows += self.conn.execute('SELECT {} FROM feed_state WHERE feed_id IN ({})'.format(columns, ', '.join('?' * len(chunk))),
+                                          chunk).fetchall()
+        return {row[0]: {
+            'last_trigger_time': row[1],
+            'last_trigger_epoch': row[2],
+            'lease_owner': row[3],
+            'lease_expires': row[4]
+        } for row in rows}
+
+    def get_states(self, feed_ids=None):
+        with self.lock:
+            return self._select(feed_ids)
+
+    def _update(self, feed_ids, func):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                states = self._select(feed_ids)
+                func(states)
+                self.conn.executemany('INSERT OR REPLACE INTO feed_state VALUES (?, ?, ?, ?, ?)',
+                                      [(feed_id, state['last_trigger_time'], state['last_trigger_epoch'],
+                                        state['lease_owner'], state['lease_expires']) for feed_id, state in states.items()])
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        """
+        Close the database connection.
+
+        """
+        self.conn.close()
+
+
+class S3StateStore(StateStore):
+    """
+    Feed state store in a single JSON object on S3, for runs on different hosts
+    (e.g. concurrent lambda invocations). Updates are written with conditional
+    requests (If-Match / If-None-Match) and retried if another run wrote the
+    object in the meantime, so concurrent updates are never lost. Conditional
+    puts need a boto3/botocore release that supports them (see requirements.txt).
+
+    Reading the object needs s3:GetObject, and s3:ListBucket on the bucket so
+    that S3 answers 404 rather than 403 while the object does not exist yet. A
+    403 is taken to mean the object does not exist until it has been read once.
+
+    """
+    def __init__(self, bucket, key, s3_helper=None, max_attempts=10, print_func=print):
+        """
+        Initialization function of the S3StateStore class.
+
+        Parameters:
+            bucket: name of the S3 bucket holding the state object.
+            key: S3 key of the state object. Created if it does not exist.
+            s3_helper: Optional S3Helper object. A new one is created on first
+                use if not given, so that creating the store does not set up an
+                AWS session.
+            max_attempts: number of times an update is attempted before giving
+                up when other runs keep writing the object.
+            print_func: function used to log conflicting writes.
+        """
+        self.bucket = bucket
+        self.key = key
+        self._s3 = s3_helper
+        self.max_attempts = max_attempts
+        self.print_func = print_func
+        self.object_seen = False
+        self.s3_checked = False
+        self.lock = threading.Lock()
+
+    @property
+    def s3(self):
+        """
+        S3Helper used to read and write the state object, created on first
+        use. Checks that the installed botocore supports conditional writes.
+
+        """
+        with self.lock:
+            if not self.s3_checked:
+                s3 = self._s3 or S3Helper()
+                put_params = s3.client.meta.service_model.operation_model('PutObject').input_shape.members
+                if 'IfMatch' not in put_params or 'IfNoneMatch' not in put_params:
+                    raise Exception('The installed botocore does not support conditional S3 writes, which S3StateStore '
+                                    'relies on. Install the versions pinned in requirements.txt.')
+                self._s3 = s3
+                self.s3_checked = True
+            return self._s3
+
+    def _read(self):
+        """
+        Read the state object.
+
+        Returns:
+            A tuple of (dictionary object of feed ID to state, ETag of the object
+            or None if it does not exist).
+        """
+        try:
+            obj = self.s3.client.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3.client.exceptions.NoSuchKey:
+            return {}, None
+        except self.s3.client.exceptions.ClientError as e:
+            if self.object_seen or e.response['Error']['Code'] not in S3_ACCESS_DENIED_ERROR_CODES:
+                raise
+            self.print_func('Access denied reading s3://{}/{}. Assuming it does not exist yet; grant s3:ListBucket '
+                            'on the bucket to tell a missing object from a permission error.'.format(self.bucket, self.key))
+            return {}, None
+        self.object_seen = True
+        return json.loads(obj['Body'].read()), obj['ETag']
+
+    def get_states(self, feed_ids=None):
+        states, _ = self._read()
+        if feed_ids is None:
+            return states
+        return {feed_id: states[feed_id] for feed_id in feed_ids if feed_id in states}
+
+    def _update(self, feed_ids, func):
+        for attempt in range(self.max_attempts):
+            states, etag = self._read()
+            func(states)
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            try:
+                self.s3.client.put_object(Bucket=self.bucket, Key=self.key,
+                                          Body=json.dumps(states).encode('utf-8'), **condition)
+                return
+            except Exception as e:
+                error_code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+                if error_code not in S3_CONFLICT_ERROR_CODES:
+                    raise
+                self.print_func('State object s3://{}/{} changed during update, retrying ({} of {}).'.format(
+                    self.bucket, self.key, attempt+1, self.max_attempts))
+        raise Exception('Unable to update state object s3://{}/{} after {} attempts.'.format(self.bucket, self.key, self.max_attempts))
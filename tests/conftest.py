@@ -0,0 +1,23 @@
+import pytest
+
+from tests.fakes import BUCKET
+
+
+@pytest.fixture
+def s3helper(monkeypatch):
+    """
+    S3Helper talking to a moto S3 mock with an empty bucket BUCKET.
+
+    """
+    moto = pytest.importorskip('moto')
+    from s3_helper import S3Helper, invalidate_aws_cache
+
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    invalidate_aws_cache()
+    with moto.mock_aws():
+        helper = S3Helper()
+        helper.client.create_bucket(Bucket=BUCKET)
+        yield helper
+    invalidate_aws_cache()
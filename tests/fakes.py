@@ -0,0 +1,201 @@
+"""
+In-memory stand-ins for the Socrata and AWS Lambda clients, shared by the tests
+and the benchmarks.
+
+"""
+from datetime import datetime, timedelta
+import re
+import threading
+import time
+
+from wzdx_registry import WZDxFeedRegistry
+
+
+DATASET_ID = 'abcd-1234'
+# bucket created in the moto S3 mock (see conftest.py)
+BUCKET = 'bkt'
+FREQUENCIES = ['30s', '5m', '15m', '1h']
+
+
+class ListLogger(object):
+    """
+    Logger that keeps the logged messages instead of printing them.
+
+    """
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg):
+        self.messages.append(msg)
+
+    error = warning = info
+
+
+class FakeSocrata(object):
+    """
+    Stand-in for sodapy.Socrata holding the rows of one dataset. Upserts with
+    an ':id' update the matching row.
+
+    """
+    domain = 'data.example.com'
+    timeout = 10
+
+    def __init__(self, rows=None, upsert_errors=None, upsert_exceptions=None):
+        """
+        Parameters:
+            rows: array of dictionary objects of the dataset rows.
+            upsert_errors: Optional array of 'Errors' counts returned by the
+                following upserts, one per call.
+            upsert_exceptions: Optional array of exceptions (or None) raised by
+                the following upserts, one per call.
+        """
+        self.rows = rows or []
+        self.upsert_errors = list(upsert_errors or [])
+        self.upsert_exceptions = list(upsert_exceptions or [])
+        self.lock = threading.Lock()
+        self.n_get = 0
+        self.n_upsert = 0
+        self.queries = []
+        self.upserted = []
+        self.by_id = {}
+
+    def get(self, dataset_id, where=None, order=None, limit=1000, offset=0, exclude_system_fields=True):
+        """
+        Honours the $where and $order clauses used by the registry:
+        "active = true", ":updated_at >= '<timestamp>'" and comma separated
+        field names.
+
+        """
+        with self.lock:
+            self.n_get += 1
+            self.queries.append({'where': where, 'order': order, 'limit': limit, 'offset': offset})
+            rows = [row for row in self.rows if self.matches(row, where)]
+            if order:
+                fields = [field.strip() for field in order.split(',')]
+                rows.sort(key=lambda row: tuple(row.get(field) or '' for field in fields))
+            rows = [dict(row) for row in rows[offset:offset+limit]]
+            if exclude_system_fields:
+                rows = [{k: v for k, v in row.items() if not k.startswith(':')} for row in rows]
+            return rows
+
+    @staticmethod
+    def matches(row, where):
+        if where is None:
+            return True
+        if where == 'active = true':
+            return bool(row.get('active'))
+        match = re.match(r"^:updated_at >= '(.+)'$", where)
+        if match:
+            return row[':updated_at'] >= match.group(1)
+        raise ValueError('Unsupported where clause: {}'.format(where))
+
+    def rows_by_id(self):
+        # rebuilt only when rows are added or removed, so that upserts into
+        # large registries stay cheap
+        if len(self.by_id) != len(self.rows):
+            self.by_id = {row[':id']: row for row in self.rows if ':id' in row}
+        return self.by_id
+
+    def upsert(self, dataset_id, recs):
+        with self.lock:
+            self.n_upsert += 1
+            exception = self.upsert_exceptions.pop(0) if self.upsert_exceptions else None
+            errors = self.upsert_errors.pop(0) if self.upsert_errors else 0
+            if exception:
+                raise exception
+            self.upserted.append(list(recs))
+            by_id = self.rows_by_id()
+            n_updated = 0
+            for rec in recs:
+                row = by_id.get(rec.get(':id'))
+                if row is not None:
+                    row.update(rec)
+                    n_updated += 1
+            # rows reported as errors are taken to be new rows that were rejected
+            return {'Rows Deleted': 0, 'Rows Updated': n_updated, 'Rows Created': len(recs) - n_updated - errors,
+                    'Errors': errors}
+
+
+class FakeLambda(object):
+    """
+    Stand-in for a boto3 Lambda client recording the payloads it is sent.
+
+    """
+    def __init__(self, latency=0, fail_every=None):
+        """
+        Parameters:
+            latency: number of seconds each invoke takes.
+            fail_every: Optional integer. If given, every n-th invoke raises.
+        """
+        self.latency = latency
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.payloads = []
+        self.n_invoke = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def invoke(self, **kwargs):
+        with self.lock:
+            self.n_invoke += 1
+            n = self.n_invoke
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if self.fail_every and n % self.fail_every == 0:
+                raise Exception('Invoke {} failed'.format(n))
+            with self.lock:
+                self.payloads.append(kwargs['Payload'])
+            return {'StatusCode': 202}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def make_rows(n_feeds, now=None, frequencies=FREQUENCIES, last_ingest_offsets=None):
+    """
+    Build synthetic feed registry rows.
+
+    Parameters:
+        n_feeds: number of rows.
+        now: datetime object the last ingest times are relative to.
+        frequencies: array of update frequencies, assigned round robin.
+        last_ingest_offsets: Optional array of timedelta objects subtracted from
+            `now` to get each row's last ingest time, assigned round robin.
+            Defaults to 0 to 19 minutes.
+
+    Returns:
+        An array of dictionary objects.
+    """
+    now = now or datetime.now()
+    offsets = last_ingest_offsets or [timedelta(minutes=i) for i in range(20)]
+    return [{
+        ':id': 'row-{}'.format(i),
+        ':updated_at': '2020-01-01T00:00:00.000Z',
+        'feedname': 'feed{}'.format(i),
+        'active': True,
+        'datafeed_frequency_update': frequencies[i % len(frequencies)],
+        'lastingestedtosandbox': (now - offsets[i % len(offsets)]).isoformat(),
+        'url': 'https://feeds.example.com/{}/wzdx.geojson'.format(i)
+    } for i in range(n_feeds)]
+
+
+def make_registry(rows=None, socrata=None, lambda_client=None, **kwargs):
+    """
+    Build a WZDxFeedRegistry on top of fake Socrata and Lambda clients.
+
+    Returns:
+        A tuple of (registry, FakeSocrata, FakeLambda).
+    """
+    socrata = socrata or FakeSocrata(rows)
+    lambda_client = lambda_client or FakeLambda()
+    kwargs.setdefault('logger', ListLogger())
+    registry = WZDxFeedRegistry(DATASET_ID, socrata_client=socrata,
+                                socrata_params={'domain': socrata.domain},
+                                lambda_to_trigger='ingest-lambda', lazy_metadata=True, **kwargs)
+    registry.lambda_client = lambda_client
+    # keep test output free of the EMF summary line
+    registry.metrics.emit = lambda *args, **kwargs: None
+    return registry, socrata, lambda_client
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from feed_scheduler import Feed, FeedScheduler, parse_frequency, parse_timestamp
+
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def make_feed(row_id, update_freq='5m', last_ingest=None, **fields):
+    row = dict({':id': row_id, 'feedname': 'feed ' + row_id, 'datafeed_frequency_update': update_freq}, **fields)
+    if last_ingest is not None:
+        row['lastingestedtosandbox'] = last_ingest.isoformat()
+    return Feed(row)
+
+
+@pytest.mark.parametrize('update_freq, expected', [
+    ('30s', timedelta(seconds=30)),
+    ('5m', timedelta(minutes=5)),
+    ('12h', timedelta(hours=12)),
+])
+def test_parse_frequency(update_freq, expected):
+    assert parse_frequency(update_freq) == expected
+
+
+def test_parse_timestamp_falls_back_to_dateutil():
+    assert parse_timestamp('2026-01-01T12:00:00') == NOW
+    assert parse_timestamp('Jan 1 2026 12:00') == NOW
+
+
+def test_feed_requires_update_frequency():
+    with pytest.raises(ValueError):
+        Feed({':id': 'a', 'feedname': 'a'})
+
+
+def test_feed_payload_caches_static_fields_and_splices_last_ingest_time():
+    feed = make_feed('a', last_ingest=NOW, url='https://example.com', **{':updated_at': 'x'})
+    assert feed.to_json() == (b'{":id": "a", "feedname": "feed a", "datafeed_frequency_update": "5m", '
+                              b'"url": "https://example.com", "lastingestedtosandbox": "2026-01-01T12:00:00"}')
+    feed.mark_ingested(NOW + timedelta(minutes=5))
+    assert feed.to_json().endswith(b'"lastingestedtosandbox": "2026-01-01T12:05:00"}')
+    assert feed.writeback_record() == {':id': 'a', 'lastingestedtosandbox': '2026-01-01T12:05:00'}
+
+
+def test_feed_payload_fields():
+    feed = Feed({':id': 'a', 'feedname': 'a', 'datafeed_frequency_update': '5m', 'url': 'u', 'notes': 'n'},
+                payload_fields=['url'])
+    assert set(feed.fields) == {':id', 'feedname', 'url'}
+
+
+def test_pop_due_returns_feeds_in_due_order():
+    scheduler = FeedScheduler()
+    scheduler.sync([
+        make_feed('late', last_ingest=NOW - timedelta(minutes=6)),
+        make_feed('never'),
+        make_feed('later', last_ingest=NOW - timedelta(minutes=10)),
+        make_feed('not due', last_ingest=NOW - timedelta(minutes=1)),
+    ])
+    assert [feed.row_id for feed in scheduler.pop_due(NOW)] == ['never', 'later', 'late']
+    assert len(scheduler) == 1
+    assert scheduler.time_until_next_due(NOW) == 240
+
+
+def test_update_reschedules_only_changed_feeds():
+    scheduler = FeedScheduler()
+    feed = make_feed('a', last_ingest=NOW - timedelta(minutes=10))
+    scheduler.update(feed)
+    scheduler.update(make_feed('a', last_ingest=NOW - timedelta(minutes=10)))
+    assert len(scheduler.heap) == 1
+    scheduler.update(make_feed('a', last_ingest=NOW))
+    assert scheduler.pop_due(NOW) == []
+    assert scheduler.time_until_next_due(NOW) == 300
+
+
+def test_not_before_delays_a_feed():
+    scheduler = FeedScheduler()
+    scheduler.update(make_feed('a'), not_before=(NOW + timedelta(seconds=60)).timestamp())
+    assert scheduler.pop_due(NOW) == []
+    assert len(scheduler.pop_due(NOW + timedelta(seconds=61))) == 1
+
+
+def test_held_feed_keeps_its_due_time_as_priority():
+    scheduler = FeedScheduler()
+    overdue = make_feed('overdue', '1h', last_ingest=NOW - timedelta(hours=3))
+    scheduler.update(overdue, not_before=(NOW + timedelta(seconds=60)).timestamp())
+    scheduler.update(make_feed('fresh', '30s', last_ingest=NOW + timedelta(seconds=15)))
+    assert scheduler.time_until_next_due(NOW) == 45
+    later = NOW + timedelta(seconds=90)
+    assert [feed.row_id for feed in scheduler.pop_due(later)] == ['overdue', 'fresh']
+
+
+def test_sync_drops_removed_feeds():
+    scheduler = FeedScheduler()
+    scheduler.sync([make_feed('a'), make_feed('b')])
+    scheduler.sync([make_feed('b')])
+    assert [feed.row_id for feed in scheduler.pop_due(NOW)] == ['b']
+    assert scheduler.next_due_epoch() is None
@@ -0,0 +1,58 @@
+"""
+Cold start budget of the trigger lambda: importing the handler module must not
+pull in boto3, botocore or dateutil, and must stay under a time budget.
+
+"""
+import os
+import subprocess
+import sys
+
+
+HANDLER_MODULE = 'lambda__wzdx_trigger_ingest'
+DEFERRED_MODULES = ('boto3', 'botocore', 'dateutil')
+# cumulative import time of the handler module, in microseconds. Override with
+# the IMPORT_TIME_BUDGET_US environment variable on slow machines.
+IMPORT_TIME_BUDGET_US = int(os.environ.get('IMPORT_TIME_BUDGET_US', 500000))
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_handler(setup='', **env):
+    """
+    Import the handler module in a fresh interpreter with `-X importtime`.
+
+    Parameters:
+        setup: Optional Python statement run after the import, with the module
+            available as `handler`.
+        env: additional environment variables.
+
+    Returns:
+        A tuple of (array of the deferred modules that were imported,
+        cumulative import time of the handler module in microseconds).
+    """
+    env = dict(os.environ, DATASET_ID='abcd-1234', LAMBDA_TO_TRIGGER='ingest-lambda',
+               SOCRATA_PARAMS='{"domain": "data.example.com", "app_token": null}', **env)
+    code = 'import sys; import {} as handler; {}; print(",".join(m for m in {!r} if m in sys.modules))'.format(
+        HANDLER_MODULE, setup or 'pass', DEFERRED_MODULES)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_DIR, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imported = [module for module in result.stdout.strip().split(',') if module]
+    cumulative_us = None
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == HANDLER_MODULE:
+            cumulative_us = int(fields[1])
+    return imported, cumulative_us
+
+
+def test_handler_import_defers_heavy_modules_and_stays_in_budget():
+    imported, cumulative_us = import_handler()
+    assert imported == []
+    assert cumulative_us is not None
+    assert cumulative_us < IMPORT_TIME_BUDGET_US, 'importing {} took {} us, budget is {} us'.format(
+        HANDLER_MODULE, cumulative_us, IMPORT_TIME_BUDGET_US)
+
+
+def test_creating_registry_with_state_store_defers_aws_session():
+    imported, _ = import_handler(setup='handler.get_wzdx_registry()', STATE_S3_BUCKET='bkt')
+    assert imported == []
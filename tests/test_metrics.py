@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+import metrics
+from metrics import Metrics, percentile
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+    assert percentile(values, 0) == 1
+    assert percentile([7], 95) == 7
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([], 50) is None
+
+
+def timed_metrics(monkeypatch, timings_ms, **kwargs):
+    # each timed block takes the next of timings_ms milliseconds
+    clock = []
+    for elapsed_ms in timings_ms:
+        clock += [0.0, elapsed_ms / 1000.0]
+    clock.reverse()
+    monkeypatch.setattr(metrics.time, 'perf_counter', clock.pop)
+    m = Metrics(**kwargs)
+    for _ in timings_ms:
+        with m.timer('invoke'):
+            pass
+    return m
+
+
+def test_summary_of_known_timings(monkeypatch):
+    m = timed_metrics(monkeypatch, [100 - i for i in range(100)])
+    m.incr('feeds_triggered', 3)
+    m.incr('feeds_triggered')
+    assert m.summary() == {
+        'timings': {'invoke': {'count': 100, 'total_ms': 5050.0, 'p50_ms': 50.0, 'p95_ms': 95.0}},
+        'counters': {'feeds_triggered': 4}
+    }
+
+
+def test_timer_records_block_that_raises(monkeypatch):
+    monkeypatch.setattr(metrics.time, 'perf_counter', iter([0.0, 0.25]).__next__)
+    m = Metrics()
+    with pytest.raises(ValueError):
+        with m.timer('invoke'):
+            raise ValueError('boom')
+    assert m.summary()['timings']['invoke']['p95_ms'] == 250.0
+
+
+def test_to_emf_structure(monkeypatch):
+    m = timed_metrics(monkeypatch, range(1, 21), namespace='Test', dimensions={'DatasetId': 'abcd-1234'})
+    m.incr('feeds_failed', 2)
+    emf = m.to_emf()
+    assert emf['DatasetId'] == 'abcd-1234'
+    assert emf['invoke.count'] == 20
+    assert emf['invoke.p50_ms'] == 10.0
+    assert emf['invoke.p95_ms'] == 19.0
+    assert emf['feeds_failed'] == 2
+    assert isinstance(emf['_aws']['Timestamp'], int)
+    assert emf['_aws']['CloudWatchMetrics'] == [{
+        'Namespace': 'Test',
+        'Dimensions': [['DatasetId']],
+        'Metrics': [
+            {'Name': 'invoke.count', 'Unit': 'Count'},
+            {'Name': 'invoke.p50_ms', 'Unit': 'Milliseconds'},
+            {'Name': 'invoke.p95_ms', 'Unit': 'Milliseconds'},
+            {'Name': 'feeds_failed', 'Unit': 'Count'}
+        ]
+    }]
+    # every metric defined in the metadata is present at the top level
+    for metric in emf['_aws']['CloudWatchMetrics'][0]['Metrics']:
+        assert metric['Name'] in emf
+
+
+def test_emit_writes_one_json_line_and_nothing_when_empty():
+    lines = []
+    m = Metrics()
+    m.emit(lines.append)
+    assert lines == []
+    m.incr('feeds_triggered')
+    m.emit(lines.append)
+    assert len(lines) == 1
+    assert json.loads(lines[0])['feeds_triggered'] == 1
+    m.reset()
+    m.emit(lines.append)
+    assert len(lines) == 1
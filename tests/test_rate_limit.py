@@ -0,0 +1,154 @@
+import threading
+
+import pytest
+
+import rate_limit
+from rate_limit import AdaptiveConcurrency, RateLimiter, TokenBucket, backoff_delay, get_retry_after, is_throttled
+from tests.fakes import ListLogger
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class ThrottleError(Exception):
+    def __init__(self, code):
+        super(ThrottleError, self).__init__(code)
+        self.response = {'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': 429}}
+
+
+class Counter(object):
+    def __init__(self):
+        self.counters = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(rate_limit.time, 'sleep', slept.append)
+    return slept
+
+
+def flaky(results):
+    """
+    Function returning (or raising) the given results, one per call.
+
+    """
+    def func():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return func
+
+
+def test_is_throttled():
+    assert is_throttled(FakeResponse(429))
+    assert is_throttled(FakeResponse(503))
+    assert not is_throttled(FakeResponse(200))
+    assert is_throttled({'Error': {'Code': 'TooManyRequestsException'}})
+    assert not is_throttled({'ResponseMetadata': {'HTTPStatusCode': 202}})
+    assert not is_throttled(None)
+
+
+def test_get_retry_after():
+    assert get_retry_after(FakeResponse(429, {'Retry-After': '3'})) == 3.0
+    assert get_retry_after(FakeResponse(429, {'Retry-After': 'Wed, 21 Oct 2026 07:28:00 GMT'})) is None
+    assert get_retry_after(FakeResponse(429)) is None
+
+
+def test_backoff_delay_is_bounded():
+    for attempt in range(1, 20):
+        assert 0 <= backoff_delay(attempt, base_delay=0.5, max_delay=4) <= min(4, 0.5 * 2 ** (attempt - 1))
+
+
+def test_throttled_responses_are_retried(sleeps):
+    metrics = Counter()
+    limiter = RateLimiter('socrata', print_func=ListLogger().info, metrics=metrics)
+    ok = FakeResponse(200)
+    func = flaky([FakeResponse(429, {'Retry-After': '2'}), FakeResponse(503), ok])
+    assert limiter.call(func) is ok
+    assert len(sleeps) == 2
+    assert sleeps[0] == 2.0
+    assert metrics.counters == {'socrata_throttled': 2}
+
+
+def test_throttling_errors_are_retried(sleeps):
+    limiter = RateLimiter('lambda', print_func=ListLogger().info)
+    func = flaky([ThrottleError('TooManyRequestsException'), {'StatusCode': 202}])
+    assert limiter.call(func) == {'StatusCode': 202}
+    assert len(sleeps) == 1
+
+
+def test_gives_up_after_max_retries(sleeps):
+    limiter = RateLimiter('lambda', max_retries=2, print_func=ListLogger().info)
+    with pytest.raises(ThrottleError):
+        limiter.call(flaky([ThrottleError('ThrottlingException')] * 3))
+    assert len(sleeps) == 2
+    throttled = FakeResponse(429)
+    assert limiter.call(flaky([throttled] * 3)) is throttled
+
+
+def test_other_errors_are_raised_without_retry(sleeps):
+    limiter = RateLimiter('lambda', print_func=ListLogger().info)
+    results = [ValueError('bad payload'), FakeResponse(200)]
+    with pytest.raises(ValueError):
+        limiter.call(flaky(results))
+    assert sleeps == []
+    assert limiter.concurrency.in_flight == 0
+
+
+def test_concurrency_limit_decreases_on_throttle_and_recovers():
+    concurrency = AdaptiveConcurrency(max_limit=8)
+    concurrency.acquire()
+    concurrency.release(throttled=True)
+    assert concurrency.limit == 4
+    concurrency.acquire()
+    concurrency.release(throttled=True)
+    assert concurrency.limit == 2
+    for _ in range(100):
+        concurrency.acquire()
+        concurrency.release()
+    assert concurrency.limit == 8
+    for _ in range(10):
+        concurrency.acquire()
+        concurrency.release(throttled=True)
+    assert concurrency.limit == 1
+
+
+def test_concurrency_limit_caps_calls_in_flight():
+    concurrency = AdaptiveConcurrency(max_limit=2)
+    concurrency.acquire()
+    concurrency.acquire()
+    acquired = threading.Event()
+
+    def acquire():
+        concurrency.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.05)
+    concurrency.release()
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_token_bucket_paces_calls_after_burst(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(rate_limit.time, 'monotonic', lambda: now[0])
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(rate_limit.time, 'sleep', sleep)
+    bucket = TokenBucket(rate=8, capacity=4)
+    for _ in range(20):
+        bucket.acquire()
+    # 4 calls from the burst, then 16 more at 8 per second
+    assert now[0] == pytest.approx(2.0)
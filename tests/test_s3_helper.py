@@ -0,0 +1,129 @@
+import gzip
+import io
+
+import pytest
+
+pytest.importorskip('moto')
+
+from s3_helper import S3NewlineJsonWriter
+from tests.fakes import BUCKET
+
+
+@pytest.fixture(autouse=True)
+def small_parts(monkeypatch):
+    # let the tests upload multipart files with small parts
+    monkeypatch.setattr('moto.s3.models.S3_UPLOAD_PART_MIN_SIZE', 1024)
+
+
+def make_recs(n):
+    return [{'id': i, 'name': 'feed {}'.format(i), 'value': i * 0.5} for i in range(n)]
+
+
+def test_small_file_written_with_single_put(s3helper, monkeypatch):
+    calls = []
+    monkeypatch.setattr(s3helper.client, 'create_multipart_upload', lambda **kwargs: calls.append(kwargs))
+    recs = make_recs(10)
+    s3helper.write_recs(recs, BUCKET, 'small.json')
+    assert calls == []
+    assert list(s3helper.read_newline_json_recs(BUCKET, 'small.json')) == recs
+
+
+def test_multipart_upload_with_several_parts(s3helper):
+    recs = make_recs(2000)
+    writer = S3NewlineJsonWriter(s3helper.client, BUCKET, 'big.json', part_size=4096, max_workers=2)
+    with writer:
+        writer.write_recs(recs)
+    assert len(writer.parts) > 1
+    assert [part['PartNumber'] for part in sorted(writer.parts, key=lambda x: x['PartNumber'])] == list(range(1, len(writer.parts) + 1))
+    assert list(s3helper.read_newline_json_recs(BUCKET, 'big.json', chunk_size=1000)) == recs
+    assert s3helper.client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+
+
+def test_gzip_round_trip(s3helper):
+    recs = make_recs(5000)
+    writer = S3NewlineJsonWriter(s3helper.client, BUCKET, 'big.json.gz', gzipped=True, part_size=4096)
+    with writer:
+        writer.write_recs(recs)
+    assert len(writer.parts) > 1
+    body = s3helper.client.get_object(Bucket=BUCKET, Key='big.json.gz')['Body'].read()
+    assert gzip.decompress(body).count(b'\n') == len(recs) - 1
+    assert list(s3helper.read_newline_json_recs(BUCKET, 'big.json.gz', chunk_size=1000)) == recs
+
+
+def test_gzip_single_put_round_trip(s3helper):
+    recs = make_recs(3)
+    s3helper.write_recs(recs, BUCKET, 'small.json.gz', gzipped=True)
+    assert list(s3helper.read_newline_json_recs(BUCKET, 'small.json.gz')) == recs
+
+
+def test_error_while_writing_aborts_upload(s3helper):
+    writer = S3NewlineJsonWriter(s3helper.client, BUCKET, 'aborted.json', part_size=4096)
+    with pytest.raises(ValueError):
+        with writer:
+            writer.write_recs(make_recs(2000))
+            raise ValueError('boom')
+    assert writer.upload_id is None
+    assert s3helper.client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert not s3helper.path_exists(BUCKET, 'aborted.json')
+
+
+def test_failed_part_aborts_upload(s3helper, monkeypatch):
+    upload_part = s3helper.client.upload_part
+
+    def failing_upload_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise IOError('connection reset')
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(s3helper.client, 'upload_part', failing_upload_part)
+    writer = S3NewlineJsonWriter(s3helper.client, BUCKET, 'failed.json', part_size=4096, max_workers=1)
+    with pytest.raises(IOError):
+        with writer:
+            writer.write_recs(make_recs(2000))
+    assert s3helper.client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+    assert not s3helper.path_exists(BUCKET, 'failed.json')
+
+
+def test_paths_exist_lists_common_prefix_once(s3helper, monkeypatch):
+    s3helper.write_bytes('{}', BUCKET, 'feeds/a.json')
+    s3helper.write_bytes('{"a": 1}', BUCKET, 'feeds/b.json')
+    listed = []
+    list_prefix = s3helper.list_prefix
+    monkeypatch.setattr(s3helper, 'list_prefix', lambda bucket, prefix: listed.append(prefix) or list_prefix(bucket, prefix))
+    result = s3helper.paths_exist(BUCKET, ['feeds/a.json', 'feeds/b.json', 'feeds/c.json'])
+    assert result == {'feeds/a.json': 2, 'feeds/b.json': 8, 'feeds/c.json': None}
+    assert listed == ['feeds/']
+
+
+def test_paths_exist_without_common_directory_checks_each_path(s3helper, monkeypatch):
+    s3helper.write_bytes('{}', BUCKET, 'a/feed.json')
+    monkeypatch.setattr(s3helper, 'list_prefix', lambda bucket, prefix: pytest.fail('listed {!r}'.format(prefix)))
+    assert s3helper.paths_exist(BUCKET, ['a/feed.json', 'b/feed.json']) == {'a/feed.json': 2, 'b/feed.json': None}
+    assert s3helper.paths_exist(BUCKET, []) == {}
+
+
+def test_paths_exist_rejects_bad_prefix(s3helper):
+    with pytest.raises(ValueError):
+        s3helper.paths_exist(BUCKET, ['a/feed.json'], prefix='')
+    with pytest.raises(ValueError):
+        s3helper.paths_exist(BUCKET, ['a/feed.json'], prefix='b/')
+
+
+def test_iter_lines_across_chunk_boundaries(s3helper):
+    data = b'first\nsecond line\n\nlast'
+    for chunk_size in (1, 3, 7, 1024):
+        assert list(s3helper.iter_lines(io.BytesIO(data), chunk_size=chunk_size)) == [b'first', b'second line', b'', b'last']
+
+
+def test_iter_lines_reads_multi_member_gzip(s3helper):
+    data = gzip.compress(b'{"a": 1}\n{"a": 2}\n') + gzip.compress(b'{"a": 3}')
+    for chunk_size in (5, 1024):
+        recs = list(s3helper.newline_json_rec_generator(io.BytesIO(data), gzipped=True, chunk_size=chunk_size))
+        assert recs == [{'a': 1}, {'a': 2}, {'a': 3}]
+
+
+def test_invalid_json_lines_are_skipped(s3helper):
+    s3helper.print_func = lambda msg: None
+    s3helper.write_bytes('{"a": 1}\nnot json\n{"a": 2}\n', BUCKET, 'mixed.json')
+    assert list(s3helper.read_newline_json_recs(BUCKET, 'mixed.json')) == [{'a': 1}, {'a': 2}]
+    assert s3helper.err_lines == [b'not json']
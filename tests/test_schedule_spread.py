@@ -0,0 +1,56 @@
+"""
+Load curve of a registry whose feeds all share a frequency and were just
+ingested at the same time, triggered by a run once a minute.
+
+"""
+from datetime import datetime, timedelta
+
+from tests.fakes import make_registry, make_rows
+
+
+START = datetime(2026, 1, 1, 12, 0, 0)
+N_FEEDS = 400
+N_RUNS = 120
+
+
+def load_curve(**kwargs):
+    """
+    Trigger a registry of N_FEEDS '15m' feeds in lockstep once a minute for
+    N_RUNS minutes.
+
+    Returns:
+        An array of the number of feeds triggered by each run.
+    """
+    now = [START]
+    rows = make_rows(N_FEEDS, now=START, frequencies=['15m'], last_ingest_offsets=[timedelta(0)])
+    registry, _, _ = make_registry(rows, clock=lambda: now[0], defer_writeback=True, **kwargs)
+    registry.refresh_schedule()
+    curve = []
+    for _ in range(N_RUNS):
+        curve.append(len(registry.trigger_due_feeds()))
+        now[0] += timedelta(minutes=1)
+    return curve
+
+
+def test_fixed_schedule_triggers_every_feed_at_once():
+    curve = load_curve()
+    assert max(curve) == N_FEEDS
+    assert curve.count(0) > N_RUNS * 3 // 4
+
+
+def test_spread_schedule_flattens_load_curve():
+    fixed = load_curve()
+    spread = load_curve(spread_schedule=True)
+    # about N_FEEDS / 15 feeds a minute instead of N_FEEDS every 15 minutes
+    assert max(spread) <= 40
+    # nothing is due in the first half window, then every run triggers some
+    assert spread[8:].count(0) == 0
+    # the same number of triggers, up to the feeds still catching up at the end
+    assert abs(sum(spread) - sum(fixed)) <= N_FEEDS
+
+
+def test_trigger_budget_caps_every_run():
+    curve = load_curve(spread_schedule=True, trigger_budget=30)
+    assert max(curve) <= 30
+    # the budget defers feeds, it does not drop them
+    assert sum(curve[15:]) >= (N_RUNS - 15) * N_FEEDS // 15 - N_FEEDS
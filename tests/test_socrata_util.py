@@ -0,0 +1,292 @@
+import random
+import time
+
+import pytest
+
+import socrata_util
+from socrata_util import SocrataDataset
+from tests.fakes import BUCKET, DATASET_ID, FakeSocrata, ListLogger
+
+
+def make_dataset(socrata):
+    return SocrataDataset(DATASET_ID, socrata_client=socrata, lazy_metadata=True, logger=ListLogger())
+
+
+def make_recs(n):
+    return [{'id': i} for i in range(n)]
+
+
+def test_upsert_in_chunks_success():
+    socrata = FakeSocrata()
+    totals, failed, partial = make_dataset(socrata).upsert_in_chunks(make_recs(25), chunk_size=10)
+    assert failed == partial == []
+    assert totals['Rows Created'] == 25
+    assert socrata.n_upsert == 3
+
+
+def test_upsert_in_chunks_does_not_resend_chunk_with_reported_errors():
+    socrata = FakeSocrata(upsert_errors=[0, 1])
+    totals, failed, partial = make_dataset(socrata).upsert_in_chunks(make_recs(20), chunk_size=10, retry_delay=0)
+    assert socrata.n_upsert == 2
+    assert failed == []
+    assert partial == make_recs(20)[10:]
+    assert totals['Rows Created'] == 19
+    assert totals['Errors'] == 1
+
+
+def test_upsert_in_chunks_retries_chunks_that_raise():
+    socrata = FakeSocrata(upsert_exceptions=[Exception('boom')])
+    totals, failed, partial = make_dataset(socrata).upsert_in_chunks(make_recs(10), chunk_size=10, retry_delay=0)
+    assert socrata.n_upsert == 2
+    assert failed == partial == []
+    assert totals['Rows Created'] == 10
+
+
+def test_upsert_in_chunks_reports_rows_of_chunks_that_raise():
+    socrata = FakeSocrata(upsert_exceptions=[Exception('boom')] * 2)
+    totals, failed, partial = make_dataset(socrata).upsert_in_chunks(make_recs(5), chunk_size=10,
+                                                                     max_retries=1, retry_delay=0)
+    assert failed == make_recs(5)
+    assert partial == []
+    assert totals['Rows Created'] == 0
+
+
+def test_clean_and_upsert_reports_partial_failure():
+    socrata = FakeSocrata(upsert_errors=[1])
+    dataset = make_dataset(socrata)
+    dataset.get_col_dtype_dict = lambda: {'id': 'number'}
+    totals = dataset.clean_and_upsert(make_recs(10), max_retries=3)
+    assert socrata.n_upsert == 1
+    assert totals['Rows Created'] == 9
+    assert totals['Rows Failed'] == 1
+
+
+def test_mod_dtype_batch_matches_mod_dtype():
+    col_dtype_dict = {'a': 'text', 'b': 'number', 'c': 'checkbox', 'd': 'point', 'lat': 'number'}
+    float_fields = ['lat']
+    values = [None, '', 0, 1, '1', '2.5', 3.5, 'x', True, {'type': 'Point'}]
+    rand = random.Random(0)
+    recs = []
+    for _ in range(2000):
+        rec = {k: rand.choice(values) for k in ['a', 'b', 'c', 'd', 'extra'] if rand.random() < 0.8}
+        rec['lat'] = str(rand.uniform(-90, 90))
+        recs.append(rec)
+    dataset = make_dataset(FakeSocrata())
+
+    def coerce_each(rec):
+        try:
+            return dataset.mod_dtype(rec, col_dtype_dict, float_fields)
+        except (TypeError, ValueError):
+            return 'error'
+
+    def coerce_batch(rec):
+        try:
+            return dataset.mod_dtype_batch([rec], col_dtype_dict, float_fields)[0]
+        except (TypeError, ValueError):
+            return 'error'
+
+    assert [coerce_each(rec) for rec in recs] == [coerce_batch(rec) for rec in recs]
+
+
+def test_mod_dtype_counts_one_metadata_cache_hit_per_fetch():
+    socrata = FakeSocrata()
+    socrata_util._metadata_cache[(socrata.domain, DATASET_ID)] = {
+        'col_dtype_dict': {'id': 'number', 'name': 'text'}, 'etag': None, 'validated_at': time.time()}
+    try:
+        dataset = make_dataset(socrata)
+        recs = [dataset.mod_dtype({'id': str(i), 'name': i, 'other': 1}) for i in range(50)]
+        assert recs[1] == {'id': 1.0, 'name': '1'}
+        dataset.mod_dtype_batch([{'id': '2'}] * 10)
+        assert dataset.metrics.counters['metadata_cache_hits'] == 1
+    finally:
+        socrata_util.invalidate_socrata_cache()
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP {}'.format(self.status_code))
+
+
+class FakeHttpSession(object):
+    """
+    Stand-in for the requests session used for the draft API calls.
+
+    """
+    def __init__(self):
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append(('GET', url, kwargs))
+        return FakeResponse()
+
+    def post(self, url, **kwargs):
+        self.calls.append(('POST', url, kwargs))
+        return FakeResponse(body={'id': 'draf-0001'})
+
+
+def make_draft_dataset(socrata, logger=None):
+    dataset = SocrataDataset(DATASET_ID, socrata_client=socrata, lazy_metadata=True, logger=logger or ListLogger(),
+                             socrata_params={'domain': socrata.domain, 'username': 'user', 'password': 'pass'})
+    dataset.http_session = FakeHttpSession()
+    socrata_util._metadata_cache[(socrata.domain, DATASET_ID)] = {
+        'col_dtype_dict': {'id': 'number'}, 'etag': None, 'validated_at': time.time()}
+    return dataset
+
+
+def test_replace_dataset_passes_timeout_to_draft_requests():
+    socrata = FakeSocrata()
+    dataset = make_draft_dataset(socrata)
+    try:
+        totals = dataset.replace_dataset(make_recs(3))
+    finally:
+        socrata_util.invalidate_socrata_cache()
+    assert totals['Rows Created'] == 3
+    methods = [call[0] for call in dataset.http_session.calls]
+    assert methods == ['POST', 'GET', 'POST']
+    assert all(call[2]['timeout'] == socrata.timeout for call in dataset.http_session.calls)
+
+
+class DraftNeverReadySession(FakeHttpSession):
+    def get(self, url, **kwargs):
+        self.calls.append(('GET', url, kwargs))
+        return FakeResponse(404)
+
+
+def test_replace_dataset_does_not_publish_draft_that_is_never_ready():
+    socrata = FakeSocrata()
+    deleted = []
+    socrata.delete = lambda dataset_id: deleted.append(dataset_id) or FakeResponse()
+    dataset = make_draft_dataset(socrata)
+    dataset.http_session = DraftNeverReadySession()
+    try:
+        with pytest.raises(Exception, match='Draft draf-0001 not ready'):
+            dataset.replace_dataset(make_recs(3), timeout=0.01)
+    finally:
+        socrata_util.invalidate_socrata_cache()
+    assert socrata.n_upsert == 0
+    assert [call[0] for call in dataset.http_session.calls].count('POST') == 1
+    assert deleted == ['draf-0001']
+
+
+def test_publish_draft_raises_if_draft_is_never_ready():
+    dataset = make_draft_dataset(FakeSocrata())
+    dataset.http_session = DraftNeverReadySession()
+    try:
+        with pytest.raises(Exception, match='not ready'):
+            dataset.publish_draft('draf-0001', timeout=0.01)
+    finally:
+        socrata_util.invalidate_socrata_cache()
+    assert [call[0] for call in dataset.http_session.calls if call[0] == 'POST'] == []
+
+
+def test_replace_dataset_keeps_original_error_if_draft_cannot_be_deleted():
+    socrata = FakeSocrata(upsert_exceptions=[Exception('upsert failed')] * 20)
+
+    def delete(dataset_id):
+        raise Exception('delete failed')
+
+    socrata.delete = delete
+    logger = ListLogger()
+    dataset = make_draft_dataset(socrata, logger)
+    try:
+        with pytest.raises(Exception, match='3 rows failed to upload to draft draf-0001'):
+            dataset.replace_dataset(make_recs(3), max_retries=0)
+    finally:
+        socrata_util.invalidate_socrata_cache()
+    assert any('Unable to discard draft draf-0001' in str(msg) for msg in logger.messages)
+
+
+class FakeMetadataSession(object):
+    """
+    Stand-in for the Socrata client's session serving the dataset metadata,
+    with an ETag per schema version and 304 answers to matching If-None-Match
+    requests.
+
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.version = 1
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.requests.append(dict(headers or {}))
+        etag = '"v{}"'.format(self.version)
+        if (headers or {}).get('If-None-Match') == etag:
+            return FakeResponse(304)
+        columns = [{'name': name, 'dataTypeName': dtype} for name, dtype in self.columns.items()]
+        return FakeResponse(body={'columns': columns}, headers={'ETag': etag})
+
+
+@pytest.fixture
+def metadata_socrata():
+    socrata_util.invalidate_socrata_cache()
+    socrata = FakeSocrata()
+    socrata.session = FakeMetadataSession({'id': 'number', 'name': 'text'})
+    yield socrata
+    socrata_util.invalidate_socrata_cache()
+
+
+def expire_metadata(dataset):
+    dataset.col_dtype_entry['validated_at'] -= dataset.metadata_ttl + 1
+
+
+def test_col_dtype_dict_is_cached_until_ttl(metadata_socrata):
+    dataset = make_dataset(metadata_socrata)
+    assert dataset.col_dtype_dict == {'id': 'number', 'name': 'text'}
+    assert make_dataset(metadata_socrata).col_dtype_dict == {'id': 'number', 'name': 'text'}
+    assert metadata_socrata.session.requests == [{}]
+
+
+def test_expired_col_dtype_dict_is_revalidated_with_etag(metadata_socrata):
+    dataset = make_dataset(metadata_socrata)
+    col_dtype_dict = dataset.col_dtype_dict
+    expire_metadata(dataset)
+    # unchanged schema: 304, the cached dictionary is kept
+    assert dataset.col_dtype_dict is col_dtype_dict
+    assert metadata_socrata.session.requests[-1] == {'If-None-Match': '"v1"'}
+    assert dataset.metrics.counters['metadata_revalidated'] == 1
+
+    metadata_socrata.session.version = 2
+    metadata_socrata.session.columns = {'id': 'text'}
+    expire_metadata(dataset)
+    assert dataset.col_dtype_dict == {'id': 'text'}
+    assert len(metadata_socrata.session.requests) == 3
+    # the new schema is cached under its new ETag
+    expire_metadata(dataset)
+    assert dataset.col_dtype_dict == {'id': 'text'}
+    assert metadata_socrata.session.requests[-1] == {'If-None-Match': '"v2"'}
+
+
+def test_col_dtype_dict_can_be_assigned(metadata_socrata):
+    dataset = make_dataset(metadata_socrata)
+    dataset.col_dtype_dict = {'id': 'text'}
+    assert dataset.col_dtype_dict == {'id': 'text'}
+    assert dataset.mod_dtype({'id': 1, 'name': 'x'}) == {'id': '1'}
+    assert metadata_socrata.session.requests == []
+    dataset.col_dtype_dict = None
+    assert dataset.col_dtype_dict == {'id': 'number', 'name': 'text'}
+
+
+def test_col_dtype_dict_is_persisted_to_s3(metadata_socrata, s3helper):
+    key = 'cache/metadata.json'
+    dataset = SocrataDataset(DATASET_ID, socrata_client=metadata_socrata, lazy_metadata=True, logger=ListLogger(),
+                             metadata_cache_bucket=BUCKET, metadata_cache_key=key)
+    assert dataset.col_dtype_dict == {'id': 'number', 'name': 'text'}
+    assert s3helper.path_exists(BUCKET, key)
+
+    # a new process starts with an empty in-process cache
+    socrata_util._metadata_cache.clear()
+    other = SocrataDataset(DATASET_ID, socrata_client=metadata_socrata, lazy_metadata=True, logger=ListLogger(),
+                           metadata_cache_bucket=BUCKET, metadata_cache_key=key)
+    assert other.col_dtype_dict == {'id': 'number', 'name': 'text'}
+    assert len(metadata_socrata.session.requests) == 1
+    assert other.metrics.counters['metadata_cache_hits'] == 1
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+import copy
+
+import pytest
+
+from state_store import S3StateStore, SQLiteStateStore
+from tests.fakes import BUCKET, FakeSocrata, ListLogger, make_registry, make_rows
+
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+KEY = 'state/feed_state.json'
+
+
+@pytest.fixture(params=['sqlite', 's3'])
+def make_store(request, tmp_path):
+    """
+    Factory of state stores sharing the same underlying state, as separate
+    hosts or processes would.
+
+    """
+    if request.param == 'sqlite':
+        stores = []
+
+        def make():
+            stores.append(SQLiteStateStore(str(tmp_path / 'state.db')))
+            return stores[-1]
+        yield make
+        for store in stores:
+            store.close()
+    else:
+        s3helper = request.getfixturevalue('s3helper')
+        yield lambda: S3StateStore(BUCKET, KEY, s3_helper=s3helper, print_func=ListLogger().info)
+
+
+def test_claim_complete_release(make_store):
+    store = make_store()
+    now = NOW.timestamp()
+    assert sorted(store.claim({'a': None, 'b': None}, 'run-1', 60, now)) == ['a', 'b']
+    # leased by run-1 until now + 60
+    assert store.claim({'a': None, 'b': None}, 'run-2', 60, now + 30) == []
+    store.complete({'a': NOW.isoformat()}, 'run-1')
+    store.release(['b'], 'run-1')
+    states = store.get_states()
+    assert states['a']['last_trigger_epoch'] == now
+    assert states['a']['lease_owner'] is None
+    assert states['b']['last_trigger_epoch'] is None
+    assert states['b']['lease_owner'] is None
+    # 'a' was triggered after run-2 last saw it, 'b' is free again
+    assert store.claim({'a': None, 'b': None}, 'run-2', 60, now + 30) == ['b']
+    assert store.claim({'a': now}, 'run-2', 60, now + 30) == ['a']
+
+
+def test_expired_lease_can_be_claimed(make_store):
+    store = make_store()
+    now = NOW.timestamp()
+    assert store.claim({'a': None}, 'run-1', 60, now) == ['a']
+    assert store.claim({'a': None}, 'run-2', 60, now + 61) == ['a']
+    assert store.get_states(['a'])['a']['lease_owner'] == 'run-2'
+
+
+def test_overlapping_runs_do_not_trigger_a_feed_twice(make_store):
+    rows = make_rows(20, now=NOW, frequencies=['1h'], last_ingest_offsets=[timedelta(hours=2)])
+    runs = []
+    for _ in range(3):
+        # every run reads its own (stale) copy of the feed registry
+        registry, _, lambda_client = make_registry(socrata=FakeSocrata(copy.deepcopy(rows)), clock=lambda: NOW,
+                                                   state_store=make_store())
+        registry.refresh_schedule()
+        runs.append((registry, lambda_client))
+    first, second, third = [registry for registry, _ in runs]
+    # the second run starts while the first is still triggering its claimed feeds
+    claimed = first.claim_feeds(first.scheduler.pop_due(NOW), NOW, NOW.timestamp() + 60)
+    assert len(claimed) == 20
+    assert second.trigger_due_feeds() == {}
+    first.complete_claims(claimed, first.trigger_feeds(claimed))
+    # the third starts after the first is done
+    assert third.trigger_due_feeds() == {}
+    assert [lambda_client.n_invoke for _, lambda_client in runs] == [20, 0, 0]
+
+
+def test_claim_failure_raises_and_reschedules_feeds(make_store, monkeypatch):
+    rows = make_rows(4, now=NOW, frequencies=['1h'], last_ingest_offsets=[timedelta(hours=2)])
+    store = make_store()
+    registry, _, lambda_client = make_registry(rows, clock=lambda: NOW, state_store=store)
+    registry.refresh_schedule()
+
+    def claim(*args, **kwargs):
+        raise IOError('state store unreachable')
+
+    monkeypatch.setattr(store, 'claim', claim)
+    with pytest.raises(IOError):
+        registry.trigger_due_feeds(retry_delay=60)
+    assert lambda_client.n_invoke == 0
+    assert registry.metrics.counters['state_claim_failed'] == 1
+    assert registry.scheduler.pop_due(NOW) == []
+    assert len(registry.scheduler.pop_due(NOW + timedelta(seconds=61))) == 4
+
+
+def test_s3_store_retries_conflicting_writes(s3helper):
+    store = S3StateStore(BUCKET, KEY, s3_helper=s3helper, print_func=ListLogger().info)
+    other = S3StateStore(BUCKET, KEY, s3_helper=s3helper, print_func=ListLogger().info)
+    store.complete({'a': NOW.isoformat()}, 'run-1')
+    calls = []
+
+    def apply(states):
+        calls.append(1)
+        if len(calls) == 1:
+            # another run writes the object between this run's read and write
+            other.complete({'b': NOW.isoformat()}, 'run-2')
+        states['c'] = dict(states['a'])
+
+    store._update(['c'], apply)
+    assert len(calls) == 2
+    assert sorted(store.get_states()) == ['a', 'b', 'c']
+
+
+def test_s3_store_treats_first_access_denied_as_missing_object(s3helper, monkeypatch):
+    from botocore.exceptions import ClientError
+
+    store = S3StateStore(BUCKET, KEY, s3_helper=s3helper, print_func=ListLogger().info)
+    get_object = s3helper.client.get_object
+    denied = [True]
+
+    def get_object_without_list_bucket(**kwargs):
+        if denied[0]:
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'GetObject')
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(s3helper.client, 'get_object', get_object_without_list_bucket)
+    assert store.get_states() == {}
+    assert store.claim({'a': None}, 'run-1', 60, NOW.timestamp()) == ['a']
+    denied[0] = False
+    assert store.get_states()['a']['lease_owner'] == 'run-1'
+    denied[0] = True
+    with pytest.raises(ClientError):
+        store.get_states()
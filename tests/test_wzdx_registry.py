@@ -0,0 +1,263 @@
+from datetime import datetime, timedelta
+import json
+import threading
+import time
+
+import pytest
+
+from tests.fakes import FakeLambda, FakeSocrata, make_registry, make_rows
+from wzdx_registry import MAX_ASYNC_PAYLOAD_BYTES
+
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def due_rows(n_feeds, **kwargs):
+    # 1h feeds last ingested 2h ago, so every feed is due
+    return make_rows(n_feeds, now=NOW, frequencies=['1h'], last_ingest_offsets=[timedelta(hours=2)], **kwargs)
+
+
+def test_ingest_triggers_due_feeds_and_writes_back():
+    rows = make_rows(8, now=NOW, frequencies=['1h'],
+                     last_ingest_offsets=[timedelta(hours=2), timedelta(minutes=10)])
+    registry, socrata, lambda_client = make_registry(rows, clock=lambda: NOW)
+    registry.ingest()
+    assert registry.n_ingest_triggered == 4
+    assert lambda_client.n_invoke == 4
+    assert set(registry.feed_results) == {'row-0', 'row-2', 'row-4', 'row-6'}
+    assert set(registry.writeback_results.values()) == {'success'}
+    assert rows[0]['lastingestedtosandbox'] == NOW.isoformat()
+    payload = json.loads(lambda_client.payloads[0])
+    assert payload['dataset_id'] == 'abcd-1234'
+    assert payload['feed'][':id'] == 'row-0'
+
+
+def test_failed_writeback_does_not_fail_triggered_feed():
+    socrata = FakeSocrata(due_rows(2), upsert_exceptions=[Exception('boom')] * 20)
+    registry, _, lambda_client = make_registry(socrata=socrata, clock=lambda: NOW)
+    registry.ingest()
+    assert lambda_client.n_invoke == 2
+    assert registry.n_ingest_triggered == 2
+    assert registry.feed_results == {'row-0': 'success', 'row-1': 'success'}
+    assert registry.writeback_results == {'row-0': 'failed', 'row-1': 'failed'}
+    assert registry.metrics.counters['writebacks_failed'] == 2
+    assert 'feeds_failed' not in registry.metrics.counters
+
+
+def test_writeback_with_reported_errors_is_failed():
+    socrata = FakeSocrata(due_rows(1), upsert_errors=[1])
+    registry, _, _ = make_registry(socrata=socrata, clock=lambda: NOW)
+    registry.ingest()
+    assert registry.feed_results == {'row-0': 'success'}
+    assert registry.writeback_results == {'row-0': 'failed'}
+
+
+def test_failed_invoke_is_reported_and_retried_later():
+    registry, _, _ = make_registry(due_rows(4), lambda_client=FakeLambda(fail_every=2), clock=lambda: NOW)
+    registry.refresh_schedule()
+    results = registry.trigger_due_feeds(retry_delay=60)
+    failed = sorted(row_id for row_id, result in results.items() if result == 'failed')
+    assert failed == ['row-1', 'row-3']
+    assert registry.n_ingest_triggered == 2
+    assert registry.metrics.counters['feeds_failed'] == 2
+    assert set(registry.writeback_results) == {'row-0', 'row-2'}
+    # the failed feeds are retried after retry_delay, the others after their frequency
+    assert registry.scheduler.time_until_next_due(NOW) == 60
+    assert registry.trigger_due_feeds() == {}
+
+
+def test_results_are_keyed_by_row_id():
+    rows = due_rows(3)
+    for row in rows:
+        row['feedname'] = 'same name'
+    registry, _, lambda_client = make_registry(rows, clock=lambda: NOW, max_workers=3)
+    registry.ingest()
+    assert registry.feed_results == {'row-0': 'success', 'row-1': 'success', 'row-2': 'success'}
+    assert registry.n_ingest_triggered == 3
+
+
+def test_deferred_writeback_is_flushed_in_bulk():
+    rows = due_rows(25)
+    registry, socrata, _ = make_registry(rows, clock=lambda: NOW, defer_writeback=True, writeback_chunk_size=10)
+    registry.ingest()
+    assert registry.n_ingest_triggered == 25
+    assert socrata.n_upsert == 3
+    assert all(len(rec) == 2 for chunk in socrata.upserted for rec in chunk)
+    assert set(registry.writeback_results.values()) == {'success'}
+
+
+def test_batched_payloads():
+    rows = due_rows(25)
+    registry, _, lambda_client = make_registry(rows, clock=lambda: NOW, batch_size=10)
+    registry.ingest()
+    assert lambda_client.n_invoke == 3
+    assert registry.n_ingest_triggered == 25
+    assert [len(json.loads(payload)['feeds']) for payload in lambda_client.payloads] == [10, 10, 5]
+    for idx, payload in enumerate(lambda_client.payloads):
+        for feed in json.loads(payload)['feeds']:
+            assert registry.feed_batches[feed[':id']] == idx
+
+
+def test_concurrent_trigger_respects_max_workers():
+    registry, _, lambda_client = make_registry(due_rows(40), lambda_client=FakeLambda(latency=0.01),
+                                               clock=lambda: NOW, max_workers=4)
+    registry.ingest()
+    assert registry.n_ingest_triggered == 40
+    assert 1 < lambda_client.max_in_flight <= 4
+
+
+def test_dry_run_triggers_nothing():
+    registry, socrata, lambda_client = make_registry(due_rows(5), clock=lambda: NOW)
+    planned = registry.ingest(dry_run=True)
+    assert len(planned) == 5
+    assert lambda_client.n_invoke == 0
+    assert socrata.n_upsert == 0
+
+
+def run_for(registry, seconds, **kwargs):
+    stop_event = threading.Event()
+    thread = threading.Thread(target=registry.run_forever, args=(stop_event,), kwargs=kwargs)
+    thread.start()
+    time.sleep(seconds)
+    stop_event.set()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_refresh_keeps_trigger_times_of_pending_writebacks():
+    rows = make_rows(6, now=datetime.now(), frequencies=['5m'], last_ingest_offsets=[timedelta(minutes=10)])
+    registry, socrata, lambda_client = make_registry(rows, defer_writeback=True, writeback_flush_interval=60)
+    # the registry is read again many times before the write-backs are flushed
+    run_for(registry, 0.5, refresh_interval=0.05, max_sleep=0.05)
+    assert lambda_client.n_invoke == 6
+    assert socrata.n_get > 2
+    # pending write-backs are flushed when the loop stops
+    assert socrata.n_upsert == 1
+    assert registry.writeback_results == {row[':id']: 'success' for row in rows}
+
+
+def test_failed_registry_read_is_retried_before_refresh_interval():
+    rows = due_rows(3)
+    socrata = FakeSocrata(rows)
+    get = socrata.get
+    calls = []
+
+    def flaky_get(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise Exception('Socrata unavailable')
+        return get(*args, **kwargs)
+
+    socrata.get = flaky_get
+    registry, _, lambda_client = make_registry(socrata=socrata)
+    run_for(registry, 0.5, refresh_interval=3600, max_sleep=0.05)
+    assert len(calls) == 2
+    assert lambda_client.n_invoke == 3
+
+
+def test_feeds_over_trigger_budget_keep_their_priority():
+    rows = make_rows(2, now=NOW, frequencies=['30s'], last_ingest_offsets=[timedelta(minutes=5)])
+    rows += make_rows(1, now=NOW, frequencies=['1h'], last_ingest_offsets=[timedelta(minutes=61)])
+    rows[2][':id'] = 'row-hourly'
+    now = [NOW]
+    registry, _, _ = make_registry(rows, clock=lambda: now[0], trigger_budget=2)
+    registry.refresh_schedule()
+    triggered = []
+    for _ in range(8):
+        triggered.append(sorted(registry.trigger_due_feeds()))
+        now[0] += timedelta(seconds=30)
+    # the 30s feeds are the most overdue at first, the hourly feed goes in
+    # the first run after its retry delay
+    assert triggered[0] == ['row-0', 'row-1']
+    assert 'row-hourly' in triggered[2]
+    assert sum(row_ids.count('row-hourly') for row_ids in triggered) == 1
+    assert all(len(row_ids) <= 2 for row_ids in triggered)
+
+
+def feed_ids(feeds):
+    return sorted(feed.row_id for feed in feeds)
+
+
+@pytest.mark.parametrize('n_rows, offsets', [(8, [0, 3, 6]), (6, [0, 3, 6])])
+def test_get_rows_pages_with_offset(n_rows, offsets):
+    registry, socrata, _ = make_registry(make_rows(n_rows, now=NOW), page_size=3)
+    assert len(registry.get_active_feeds()) == n_rows
+    assert [query['offset'] for query in socrata.queries] == offsets
+    assert all(query['limit'] == 3 and query['order'] == ':id' for query in socrata.queries)
+
+
+def test_incremental_read_merges_rows_updated_since_watermark():
+    rows = make_rows(6, now=NOW)
+    registry, socrata, _ = make_registry(rows, incremental=True, page_size=4)
+    assert len(registry.get_active_feeds()) == 6
+    assert socrata.queries[-1]['where'] == 'active = true'
+
+    rows[0].update({':updated_at': '2020-01-02T00:00:00.000Z', 'datafeed_frequency_update': '12h'})
+    rows[1].update({':updated_at': '2020-01-02T00:00:00.000Z', 'active': False})
+    rows.append(dict(make_rows(1, now=NOW)[0], **{':id': 'row-new', ':updated_at': '2020-01-03T00:00:00.000Z'}))
+    n_queries = len(socrata.queries)
+    feeds = registry.get_active_feeds()
+    incremental_query = socrata.queries[n_queries]
+    # rows at the watermark are read again, so all rows come back this time
+    assert incremental_query['where'] == ":updated_at >= '2020-01-01T00:00:00.000Z'"
+    assert incremental_query['order'] == ':updated_at, :id'
+    assert feed_ids(feeds) == ['row-0', 'row-2', 'row-3', 'row-4', 'row-5', 'row-new']
+    assert [feed.update_freq for feed in feeds if feed.row_id == 'row-0'] == ['12h']
+    assert registry.updated_at_watermark == '2020-01-03T00:00:00.000Z'
+
+    n_queries = len(socrata.queries)
+    assert feed_ids(registry.get_active_feeds()) == feed_ids(feeds)
+    assert [query['where'] for query in socrata.queries[n_queries:]] == [":updated_at >= '2020-01-03T00:00:00.000Z'"]
+
+
+def test_incremental_read_does_full_refresh_after_interval():
+    rows = make_rows(4, now=NOW)
+    registry, socrata, _ = make_registry(rows, incremental=True, full_refresh_interval=3600)
+    registry.get_active_feeds()
+    # rows deleted from the registry do not show up in incremental reads
+    del rows[3]
+    assert len(registry.get_active_feeds()) == 4
+    registry.last_full_refresh_time -= 3600
+    feeds = registry.get_active_feeds()
+    assert socrata.queries[-1]['where'] == 'active = true'
+    assert feed_ids(feeds) == ['row-0', 'row-1', 'row-2']
+
+
+class LimitedLambda(FakeLambda):
+    """
+    FakeLambda rejecting payloads over the asynchronous invocation limit, as
+    AWS does.
+
+    """
+    def invoke(self, **kwargs):
+        if len(kwargs['Payload']) > MAX_ASYNC_PAYLOAD_BYTES:
+            raise Exception('RequestEntityTooLargeException')
+        return super(LimitedLambda, self).invoke(**kwargs)
+
+
+def large_rows(sizes):
+    rows = due_rows(len(sizes))
+    for row, size in zip(rows, sizes):
+        row['notes'] = 'x' * size
+    return rows
+
+
+def test_batches_are_split_at_payload_limit():
+    rows = large_rows([100 * 1024] * 5)
+    registry, _, lambda_client = make_registry(rows, lambda_client=LimitedLambda(), clock=lambda: NOW, batch_size=10)
+    batches = registry.make_batches(registry.to_feeds(rows))
+    assert [len(feeds) for _, feeds, _ in batches] == [2, 2, 1]
+    assert all(len(payload) <= MAX_ASYNC_PAYLOAD_BYTES for _, _, payload in batches)
+    registry.ingest()
+    assert lambda_client.n_invoke == 3
+    assert set(registry.feed_results.values()) == {'success'}
+
+
+def test_feed_over_payload_limit_is_batched_alone():
+    rows = large_rows([10, MAX_ASYNC_PAYLOAD_BYTES, 10, 10])
+    registry, _, lambda_client = make_registry(rows, lambda_client=LimitedLambda(), clock=lambda: NOW, batch_size=10)
+    batches = registry.make_batches(registry.to_feeds(rows))
+    assert [[feed.row_id for feed in feeds] for _, feeds, _ in batches] == [['row-0'], ['row-1'], ['row-2', 'row-3']]
+    registry.ingest()
+    assert registry.feed_results == {'row-0': 'success', 'row-1': 'failed', 'row-2': 'success', 'row-3': 'success'}
+    assert lambda_client.n_invoke == 2
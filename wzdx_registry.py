@@ -2,23 +2,41 @@
 Class for triggering ingestion lambda functions when needed based on WZDx Feed Registry Scorata dataset.
 
 """
-from copy import deepcopy
-from datetime import datetime, timedelta
-import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import json
-import requests
-import re
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
 
+from feed_scheduler import Feed, FeedScheduler, parse_frequency, parse_timestamp
+from rate_limit import RateLimiter
 from socrata_util import SocrataDataset
 from s3_helper import aws_helper
 
 
+# AWS limit on the payload of an asynchronous ('Event') lambda invocation
+MAX_ASYNC_PAYLOAD_BYTES = 256 * 1024
+# Claimed feeds stay leased for the maximum lambda timeout by default, so a
+# lease cannot expire while the run that holds it may still be triggering
+DEFAULT_LEASE_SECONDS = 900
+
+
 class WZDxFeedRegistry(SocrataDataset):
     """
     Class to interact with the WZDx Feed Registry Socrata Dataset.
 
     """
-    def __init__(self, dataset_id, lambda_to_trigger=None, aws_profile=None, **kwargs):
+    def __init__(self, dataset_id, lambda_to_trigger=None, aws_profile=None,
+                 defer_writeback=False, writeback_chunk_size=500,
+                 writeback_flush_interval=None, writeback_max_retries=3,
+                 max_workers=1, page_size=1000, incremental=False,
+                 full_refresh_interval=3600, clock=None, batch_size=None,
+                 payload_fields=None, lambda_rate_limit=None, state_store=None,
+                 lease_seconds=DEFAULT_LEASE_SECONDS, spread_schedule=False, trigger_budget=None, **kwargs):
         """
         Initialization function of the WZDxFeedRegistry class.
 
@@ -44,23 +62,215 @@ class WZDxFeedRegistry(SocrataDataset):
                 this parameter if you will be using your default profile. For
                 additional information on how to set up the credential file, see
                 https://docs.aws.amazon.com/sdk-for-php/v3/developer-guide/guide_credentials_profiles.html
+            defer_writeback: Optional boolean. If True, the "last ingested to
+                sandbox" updates are collected and written back to the registry
+                in bulk instead of with one upsert per triggered feed.
+            writeback_chunk_size: Maximum number of feeds per bulk upsert when
+                defer_writeback is True. Pending updates are also flushed as soon
+                as this many have been collected.
+            writeback_flush_interval: Optional number of seconds. When
+                defer_writeback is True, pending updates are flushed once this
+                much time has passed since the last flush.
+            writeback_max_retries: Number of times a failed bulk upsert chunk is
+                retried before its feeds are reported as failed.
+            max_workers: Maximum number of feeds triggered concurrently. Defaults
+                to 1, which triggers feeds one at a time.
+            page_size: Number of registry rows requested per page when reading
+                the feed registry.
+            incremental: Optional boolean. If True, a snapshot of the active
+                feeds is kept between runs and only rows whose `:updated_at` is
+                at or after the last seen value are read from the registry.
+            full_refresh_interval: Number of seconds after which an incremental
+                snapshot is rebuilt from a full read, so that rows deleted from
+                the registry are dropped.
+            clock: Optional function returning the current time as a datetime
+                object. Defaults to datetime.now. Pass in a different function
+                to plan or replay runs at a given time.
+            batch_size: Optional maximum number of feeds sent to the ingestion
+                lambda per invocation. If given, due feeds are grouped into
+                payloads of the form {'feeds': [...], 'dataset_id': ...}, each
+                kept within the asynchronous invocation payload limit, instead
+                of one {'feed': ..., 'dataset_id': ...} invocation per feed.
+                The ingestion lambda must accept the batched payload.
+            payload_fields: Optional array of feed registry field names sent to
+                the ingestion lambda for each feed. Defaults to all fields
+                except the Socrata system fields other than ':id'.
+            lambda_rate_limit: Optional maximum number of ingestion lambda
+                invocations per second. Whether or not it is given, concurrent
+                invocations are limited to max_workers, the limit is lowered
+                when Lambda throttles and throttled invocations are retried with
+                jittered backoff. Socrata requests are limited with rate_limit.
+            state_store: Optional StateStore object (see state_store.py) holding
+                the time each feed was last triggered and the leases of running
+                triggers. If given, it takes precedence over the
+                `lastingestedtosandbox` field for scheduling, a feed is only
+                triggered once its lease is claimed (so overlapping runs do not
+                trigger it twice), and the registry is updated in bulk in the
+                background, as if defer_writeback were set.
+            lease_seconds: Number of seconds a claimed feed stays leased to this
+                run before other runs may claim it again. Should be at least as
+                long as a run may take (e.g. the lambda timeout), otherwise
+                another run may trigger the feed while this one still is.
+            spread_schedule: Optional boolean. If True, each feed is triggered
+                on a fixed, per-feed offset within its update frequency window
+                (see FeedScheduler), spreading feeds that share a frequency over
+                the window instead of triggering them in the same run.
+            trigger_budget: Optional maximum number of feeds triggered per run.
+                Due feeds over the budget are held for a minute and then
+                triggered ahead of feeds that became due after them.
         """
         super(WZDxFeedRegistry, self).__init__(dataset_id, **kwargs)
         self.lambda_to_trigger=lambda_to_trigger
-        self.aws = aws_helper(aws_profile)
+        self.clock = clock or datetime.now
+        self.aws_profile = aws_profile
+        self._aws = None
+
+        self.state_store = state_store
+        self.lease_seconds = lease_seconds
+        self.owner_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        self.defer_writeback = defer_writeback or state_store is not None
+        self.writeback_chunk_size = writeback_chunk_size
+        self.writeback_flush_interval = writeback_flush_interval
+        self.writeback_max_retries = writeback_max_retries
+        self.pending_writebacks = []
+        self.last_flush_time = time.time()
+        self.writeback_executor = None
+        self.writeback_future = None
+
+        self.max_workers = max_workers
+        self.lambda_client = None
+        self.lambda_rate_limiter = RateLimiter('lambda', rate=lambda_rate_limit, max_concurrency=max_workers,
+                                               print_func=self.print_func, metrics=self.metrics)
+        self.lock = threading.Lock()
 
         self.n_ingest_triggered = 0
+        self.feed_results = {}
+        self.writeback_results = {}
+        self.batch_size = batch_size
+        self.feed_batches = {}
+        self.payload_fields = payload_fields
 
-    def get_active_feeds(self):
+        self.page_size = page_size
+        self.incremental = incremental
+        self.full_refresh_interval = full_refresh_interval
+        self.feed_snapshot = {}
+        self.updated_at_watermark = None
+        self.last_full_refresh_time = None
+
+        self.trigger_budget = trigger_budget
+        self.scheduler = FeedScheduler(spread=spread_schedule)
+
+    @property
+    def aws(self):
+        """
+        AWS helper used to invoke the ingestion lambda. Only created once it is
+        needed, so runs that trigger nothing never set up an AWS session.
+
+        """
+        if self._aws is None:
+            self._aws = aws_helper(self.aws_profile, pool_size=max(self.pool_size, self.max_workers))
+        return self._aws
+
+    def get_rows(self, where, order=':id'):
         """
-        Method for getting all active feeds from the feed registry.
+        Method for reading all rows of the feed registry matching a filter, one
+        page of `page_size` rows at a time.
+
+        Parameters:
+            where: SoQL $where clause.
+            order: SoQL $order clause. Should give a stable order for paging.
 
         Returns:
             An array of dictionary objects with each object being a row (feed)
-            in the feed registry where `active`=true
+            in the feed registry, including system fields.
+        """
+        rows = []
+        offset = 0
+        while True:
+            page = self.rate_limiter.call(self.client.get, self.dataset_id, where=where, order=order,
+                                          limit=self.page_size, offset=offset,
+                                          exclude_system_fields=False)
+            rows += page
+            if len(page) < self.page_size:
+                return rows
+            offset += self.page_size
+
+    def get_active_feeds(self):
+        """
+        Method for getting all active feeds from the feed registry. In
+        incremental mode, only rows updated since the previous call are read and
+        merged into the local snapshot of the registry.
+
+        Returns:
+            An array of Feed objects, one per row (feed) in the feed registry
+            where `active`=true
+        """
+        with self.metrics.timer('get_active_feeds'):
+            feeds = self._get_active_feeds()
+        self.metrics.incr('feeds_active', len(feeds))
+        return feeds
+
+    def _get_active_feeds(self):
+        if not self.incremental:
+            return self.to_feeds(self.get_rows('active = true'))
+
+        refresh_due = (self.updated_at_watermark is None or
+                       time.time() - self.last_full_refresh_time >= self.full_refresh_interval)
+        if refresh_due:
+            self.feed_snapshot = {}
+            self.updated_at_watermark = None
+            self.last_full_refresh_time = time.time()
+            rows = self.get_rows('active = true')
+        else:
+            # rows updated at exactly the watermark are read again, since rows
+            # sharing that timestamp may have been written after the last read
+            rows = self.get_rows(":updated_at >= '{}'".format(self.updated_at_watermark),
+                                 order=':updated_at, :id')
+        for row in rows:
+            self.feed_snapshot.pop(row[':id'], None)
+            if row.get('active'):
+                for feed in self.to_feeds([row]):
+                    self.feed_snapshot[feed.row_id] = feed
+            if self.updated_at_watermark is None or row[':updated_at'] > self.updated_at_watermark:
+                self.updated_at_watermark = row[':updated_at']
+        self.print_func('{} registry rows read ({}).'.format(len(rows), 'full refresh' if refresh_due else 'incremental'))
+        return list(self.feed_snapshot.values())
+
+    def to_feeds(self, rows):
+        """
+        Method for converting feed registry rows into Feed objects. Rows that
+        cannot be scheduled (e.g. with an invalid update frequency) are logged
+        and skipped.
+
+        Parameters:
+            rows: array of dictionary objects of feed registry records.
+
+        Returns:
+            An array of Feed objects.
+        """
+        feeds = []
+        for row in rows:
+            try:
+                feeds.append(Feed(row, self.payload_fields))
+            except Exception:
+                self.print_func(traceback.format_exc())
+                self.print_func('Skip invalid feed registry row {}'.format(row.get(':id')))
+        return feeds
+
+    def as_feed(self, feed):
+        """
+        Method for accepting either a Feed object or a feed registry record.
+
+        Parameters:
+            feed: Feed object or dictionary object of a feed registry record.
+
+        Returns:
+            Feed object.
         """
-        data = self.client.get(self.dataset_id, where='active = true', exclude_system_fields=False)
-        return data
+        if isinstance(feed, Feed):
+            return feed
+        return Feed(feed, self.payload_fields)
 
     def get_next_ingest_time(self, update_freq, last_ingest_time):
         """
@@ -79,75 +289,631 @@ class WZDxFeedRegistry(SocrataDataset):
         Returns:
             Datetime object for next ingestion time.
         """
-        time_unit_dict = {'h': 'hours', 'm': 'minutes', 's': 'seconds'}
-
-        time_regex = r'(\d+)(\w+)'
-        time_num, time_unit = re.findall(time_regex, update_freq)[0]
-        time_num = int(time_num)
-        time_unit = time_unit_dict[time_unit]
-        next_ingest_time = dateutil.parser.parse(last_ingest_time) + timedelta(**{time_unit: time_num})
+        next_ingest_time = parse_timestamp(last_ingest_time) + parse_frequency(update_freq)
         return next_ingest_time
 
     def trigger_lambda_ingestion(self, feed):
         """
         Method to trigger an ingestion lambda function on a particular feed. The
         "last ingested to sandbox" field for the feed's record in the WZDx Feed
-        Registry will be updated to the current UTC timestamp.
-
-        Parameters:
-            feed: dictionary object. Should be a record read from the WZDx feed
-                registry Socrata dataset, with all fields, including the system
-                fields (e.g. ':id').
-        """
-        self.print_func('Trigger {} for {}'.format(self.lambda_to_trigger, feed['feedname']))
-        # invoke lambda asynchronously
-        data_to_send = {'feed': feed, 'dataset_id': self.dataset_id}
-        lambda_client = self.aws.session.client('lambda')
-        response = lambda_client.invoke(
-            FunctionName=self.lambda_to_trigger,
-            InvocationType='Event',
-            LogType='Tail',
-            ClientContext='',
-            Payload=json.dumps(data_to_send).encode('utf-8'),
-        )
-        self.print_func(response)
+        Registry will be updated to the current UTC timestamp. Raises if the
+        invocation fails; a failed registry update is only logged and reported
+        in `writeback_results`.
+
+        Parameters:
+            feed: Feed object, or dictionary object of a record read from the
+                WZDx feed registry Socrata dataset, with all fields, including
+                the system fields (e.g. ':id').
+        """
+        feed = self.as_feed(feed)
+        self.print_func('Trigger {} for {}'.format(self.lambda_to_trigger, feed.feedname))
+        payload = b'{"feed": ' + feed.to_json() + b', "dataset_id": ' + json.dumps(self.dataset_id).encode('utf-8') + b'}'
+        self.invoke_ingestion(payload)
+        self.record_ingestion(feed)
+
+    def trigger_lambda_ingestion_batch(self, batch_idx, feeds, payload):
+        """
+        Method to trigger one ingestion lambda function invocation for a batch
+        of feeds. The "last ingested to sandbox" field of each feed is updated
+        once the invocation has been accepted.
+
+        Parameters:
+            batch_idx: index of the batch in the current run.
+            feeds: array of Feed objects in the batch.
+            payload: serialized payload of the batch, as built by make_batches.
+        """
+        self.print_func('Trigger {} for batch {} ({} feeds: {})'.format(
+            self.lambda_to_trigger, batch_idx, len(feeds), ', '.join(feed.feedname for feed in feeds)))
+        self.invoke_ingestion(payload)
+        for feed in feeds:
+            self.record_ingestion(feed)
 
-        # update last ingest time
-        feed['lastingestedtosandbox'] = datetime.now().isoformat()
-        response = self.client.upsert(self.dataset_id, [feed])
+    def invoke_ingestion(self, payload):
+        """
+        Method to invoke the ingestion lambda function asynchronously.
+
+        Parameters:
+            payload: bytes of the JSON payload to send.
+        """
+        lambda_client = self.get_lambda_client()
+        with self.metrics.timer('lambda_invoke'):
+            response = self.lambda_rate_limiter.call(
+                lambda_client.invoke,
+                FunctionName=self.lambda_to_trigger,
+                InvocationType='Event',
+                LogType='Tail',
+                ClientContext='',
+                Payload=payload,
+            )
         self.print_func(response)
-        self.n_ingest_triggered += 1
 
-    def check_feed(self, feed):
+    def record_ingestion(self, feed):
+        """
+        Method to count a triggered feed, update its "last ingested to sandbox"
+        field and write it back to the WZDx Feed Registry (immediately, or with
+        the next bulk write-back if defer_writeback is set). The outcome of the
+        write-back is recorded in `writeback_results` ('success', 'failed', or
+        'pending' until the next bulk write-back) and never raises, since the
+        feed has been triggered either way.
+
+        Parameters:
+            feed: Feed object.
+
+        Returns:
+            Boolean (True/False) indicating if the write-back succeeded or was
+            queued.
+        """
+        feed.mark_ingested(self.clock())
+        with self.lock:
+            self.n_ingest_triggered += 1
+        if self.defer_writeback:
+            with self.lock:
+                self.pending_writebacks.append(feed)
+                self.writeback_results[feed.row_id] = 'pending'
+            self.maybe_flush_writebacks()
+            return True
+
+        try:
+            with self.metrics.timer('writeback_upsert'):
+                response = self.rate_limiter.call(self.client.upsert, self.dataset_id, [feed.writeback_record()])
+            self.print_func(response)
+            success = not response.get('Errors')
+        except Exception:
+            self.print_func(traceback.format_exc())
+            success = False
+        if not success:
+            self.print_func('Failed to update lastingestedtosandbox for {}'.format(feed.feedname))
+            self.metrics.incr('writebacks_failed')
+        with self.lock:
+            self.writeback_results[feed.row_id] = 'success' if success else 'failed'
+        return success
+
+    def get_lambda_client(self):
+        """
+        Method for getting the lambda client used to invoke the ingestion lambda.
+        The client is created once and shared by all worker threads, since boto3
+        clients are thread safe while sessions are not. It is also cached at
+        module level, so warm lambda containers reuse it.
+
+        Returns:
+            AWS Lambda client.
+        """
+        with self.lock:
+            if self.lambda_client is None:
+                self.lambda_client = self.aws.get_client('lambda')
+        return self.lambda_client
+
+    def maybe_flush_writebacks(self):
+        """
+        Method to flush pending "last ingested to sandbox" updates if either the
+        chunk size or the flush interval threshold has been reached. With a
+        state store, the flush runs in the background.
+
+        """
+        with self.lock:
+            n_pending = len(self.pending_writebacks)
+        flush_due = n_pending >= self.writeback_chunk_size or (
+            self.writeback_flush_interval is not None and time.time() - self.last_flush_time >= self.writeback_flush_interval)
+        if not flush_due:
+            return
+        if self.state_store:
+            self.flush_writebacks_async()
+        else:
+            self.flush_writebacks()
+
+    def flush_writebacks_async(self):
+        """
+        Method to start flushing pending "last ingested to sandbox" updates in a
+        background thread, unless a background flush is already running.
+
+        """
+        with self.lock:
+            if self.writeback_future is not None and not self.writeback_future.done():
+                return
+            if self.writeback_executor is None:
+                self.writeback_executor = ThreadPoolExecutor(max_workers=1)
+            self.writeback_future = self.writeback_executor.submit(self.flush_writebacks)
+
+    def wait_for_writebacks(self):
+        """
+        Method to wait for a running background flush to finish.
+
+        """
+        future = self.writeback_future
+        if future is not None:
+            future.result()
+
+    def flush_writebacks(self):
+        """
+        Method to write all pending "last ingested to sandbox" updates back to
+        the WZDx Feed Registry in chunked bulk upserts. Only chunks that fail
+        are retried. Feeds whose update could not be written are logged.
+
+        Returns:
+            An array of the Feed objects whose update failed.
+        """
+        with self.lock:
+            feeds, self.pending_writebacks = self.pending_writebacks, []
+            self.last_flush_time = time.time()
+        if not feeds:
+            return []
+        # a feed triggered more than once since the last flush is written once
+        feeds = list({feed.row_id: feed for feed in feeds}.values())
+        with self.metrics.timer('flush_writebacks'):
+            totals, failed_recs, partial_recs = self.upsert_in_chunks([feed.writeback_record() for feed in feeds],
+                                                                      chunk_size=self.writeback_chunk_size,
+                                                                      max_retries=self.writeback_max_retries)
+        # the response does not say which rows of a chunk with errors were
+        # rejected, so all of them count as failed (rewriting them is harmless)
+        failed_ids = {rec[':id'] for rec in failed_recs + partial_recs}
+        failed_feeds = [feed for feed in feeds if feed.row_id in failed_ids]
+        with self.lock:
+            for feed in feeds:
+                self.writeback_results[feed.row_id] = 'failed' if feed.row_id in failed_ids else 'success'
+        self.metrics.incr('writebacks_failed', len(failed_feeds))
+        self.print_func(totals)
+        for feed in failed_feeds:
+            self.print_func('Failed to update lastingestedtosandbox for {}'.format(feed.feedname))
+        if self.state_store and failed_feeds:
+            # the state store already holds the trigger times, so the registry
+            # update is kept for the next flush instead of being dropped
+            with self.lock:
+                self.pending_writebacks = failed_feeds + self.pending_writebacks
+        return failed_feeds
+
+    def is_feed_due(self, feed):
         """
         Method to check if the ingestion lambda should be triggered for a feed
         based on its last ingest time and update frequency.
 
         Parameters:
-            feed: dictionary object. Should be a record read from the WZDx feed
-                registry Socrata dataset, with all fields, including the system
-                fields (e.g. ':id').
+            feed: Feed object, or dictionary object of a record read from the
+                WZDx feed registry Socrata dataset, with all fields, including
+                the system fields (e.g. ':id').
+
+        Returns:
+            Boolean (True/False)
+        """
+        return self.clock().timestamp() > self.scheduler.next_ingest_epoch(self.as_feed(feed))
+
+    def check_feed(self, feed):
         """
-        update_freq = feed.get('datafeed_frequency_update')
-        last_ingest_time = feed.get('lastingestedtosandbox')
-        if not last_ingest_time:
+        Method to check if the ingestion lambda should be triggered for a feed
+        based on its last ingest time and update frequency, and trigger it if so.
+
+        Parameters:
+            feed: Feed object, or dictionary object of a record read from the
+                WZDx feed registry Socrata dataset, with all fields, including
+                the system fields (e.g. ':id').
+        """
+        feed = self.as_feed(feed)
+        if self.is_feed_due(feed):
             self.trigger_lambda_ingestion(feed)
         else:
-            next_ingest_time = self.get_next_ingest_time(update_freq, last_ingest_time)
-            if datetime.now() > next_ingest_time:
-                self.trigger_lambda_ingestion(feed)
-            else:
-                self.print_func('Skip {}'.format(feed['feedname']))
+            self.print_func('Skip {}'.format(feed.feedname))
 
-    def ingest(self):
+    def try_trigger_lambda_ingestion(self, feed):
         """
-        Method to retrieve all active feeds from the WZDx Feed Registry and trigger
-        ingestion for each feed based on its last ingest time and update frequency.
+        Method to trigger ingestion for a feed and record in `feed_results`
+        (keyed by row ID) whether its invocation succeeded, without letting a
+        single failing feed abort the run.
+
+        Parameters:
+            feed: Feed object, or dictionary object of a record read from the
+                WZDx feed registry Socrata dataset, with all fields, including
+                the system fields (e.g. ':id').
+
+        Returns:
+            Boolean (True/False) indicating if the feed was triggered successfully.
+        """
+        feed = self.as_feed(feed)
+        try:
+            self.trigger_lambda_ingestion(feed)
+            success = True
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Failed to trigger {} for {}'.format(self.lambda_to_trigger, feed.feedname))
+            success = False
+        with self.lock:
+            self.feed_results[feed.row_id] = 'success' if success else 'failed'
+        self.metrics.incr('feeds_triggered' if success else 'feeds_failed')
+        return success
+
+    def try_trigger_lambda_ingestion_batch(self, batch):
+        """
+        Method to trigger ingestion for a batch of feeds and record in
+        `feed_results` and `feed_batches` (keyed by row ID) whether and in which
+        batch each feed was triggered, without letting a failing batch abort the run.
+
+        Parameters:
+            batch: tuple of (batch index, array of Feed objects, payload), as
+                built by make_batches.
+
+        Returns:
+            Boolean (True/False) indicating if the batch was triggered successfully.
+        """
+        batch_idx, feeds, payload = batch
+        try:
+            self.trigger_lambda_ingestion_batch(batch_idx, feeds, payload)
+            success = True
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Failed to trigger {} for batch {}'.format(self.lambda_to_trigger, batch_idx))
+            success = False
+        with self.lock:
+            for feed in feeds:
+                self.feed_results[feed.row_id] = 'success' if success else 'failed'
+                self.feed_batches[feed.row_id] = batch_idx
+        self.metrics.incr('feeds_triggered' if success else 'feeds_failed', len(feeds))
+        self.metrics.incr('batches_triggered' if success else 'batches_failed')
+        return success
+
+    def make_batches(self, feeds):
+        """
+        Method to group feeds into batches of at most `batch_size` feeds whose
+        serialized payload stays within the asynchronous lambda payload limit.
+        Each feed is serialized only once. A feed over the limit on its own is
+        put in a batch by itself, so that only its invocation fails.
+
+        Parameters:
+            feeds: array of Feed objects.
+
+        Returns:
+            Array of tuples of (batch index, array of Feed objects, payload bytes).
+        """
+        head = '{{"dataset_id": {}, "feeds": ['.format(json.dumps(self.dataset_id)).encode('utf-8')
+        tail = b']}'
+        batches = []
+        batch_feeds, batch_parts, batch_bytes = [], [], len(head) + len(tail)
+
+        def close_batch():
+            payload = head + b', '.join(batch_parts) + tail
+            batches.append((len(batches), batch_feeds, payload))
+
+        for feed in feeds:
+            part = feed.to_json()
+            part_bytes = len(part) + 2
+            if batch_feeds and (len(batch_feeds) >= self.batch_size or
+                                batch_bytes + part_bytes > MAX_ASYNC_PAYLOAD_BYTES):
+                close_batch()
+                batch_feeds, batch_parts, batch_bytes = [], [], len(head) + len(tail)
+            batch_feeds.append(feed)
+            batch_parts.append(part)
+            batch_bytes += part_bytes
+        if batch_feeds:
+            close_batch()
+        return batches
 
+    def trigger_feeds(self, feeds):
+        """
+        Method to trigger ingestion for a list of due feeds, using up to
+        `max_workers` concurrent lambda invocations. If `batch_size` is set,
+        feeds are grouped and each group is sent in a single invocation.
+
+        Parameters:
+            feeds: array of Feed objects, or dictionary objects of records read
+                from the WZDx feed registry Socrata dataset.
+
+        Returns:
+            Dictionary object with the feed's row ID as key and 'success' or
+            'failed' (the outcome of the invocation) as value. The outcome of
+            each registry write-back is in `writeback_results`.
+        """
+        feeds = [self.as_feed(feed) for feed in feeds]
+        if self.batch_size:
+            func, units = self.try_trigger_lambda_ingestion_batch, self.make_batches(feeds)
+        else:
+            func, units = self.try_trigger_lambda_ingestion, feeds
+        if self.max_workers > 1 and len(units) > 1:
+            self.get_lambda_client()
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(func, units))
+        else:
+            for unit in units:
+                func(unit)
+        return {feed.row_id: self.feed_results[feed.row_id] for feed in feeds}
+
+    def refresh_schedule(self):
+        """
+        Method to read the active feeds from the WZDx Feed Registry and bring the
+        scheduler in line with them.
+
+        Returns:
+            Number of active feeds.
         """
         feeds = self.get_active_feeds()
         self.print_func('{} active feeds found in Socrata Feed Registry at http://{}/d/{}.'.format(len(feeds), self.socrata_params['domain'], self.dataset_id))
+        self.apply_known_ingest_times(feeds)
+        if self.state_store:
+            self.apply_state(feeds)
+        self.scheduler.sync(feeds)
+        return len(feeds)
 
+    def apply_known_ingest_times(self, feeds):
+        """
+        Method to update the last ingest time of feeds read from the registry
+        with the time this instance last triggered them, where that is more
+        recent, e.g. because its write-back is still pending or failed.
+
+        Parameters:
+            feeds: array of Feed objects.
+        """
+        with self.lock:
+            known = {feed.row_id: feed for feed in self.pending_writebacks}
+        for feed in feeds:
+            for known_feed in (known.get(feed.row_id), self.scheduler.get(feed.row_id)):
+                if known_feed is None or known_feed is feed or known_feed.last_ingest_epoch is None:
+                    continue
+                if feed.last_ingest_epoch is None or known_feed.last_ingest_epoch > feed.last_ingest_epoch:
+                    feed.set_last_ingest_time(known_feed.last_ingest_time)
+
+    def apply_state(self, feeds):
+        """
+        Method to update the last ingest time of feeds from the state store,
+        where it is more recent than the one read from the feed registry.
+
+        Parameters:
+            feeds: array of Feed objects.
+        """
+        with self.metrics.timer('state_read'):
+            states = self.state_store.get_states([feed.row_id for feed in feeds])
         for feed in feeds:
-            self.check_feed(feed)
+            state = states.get(feed.row_id)
+            if not state or state['last_trigger_epoch'] is None:
+                continue
+            if feed.last_ingest_epoch is None or state['last_trigger_epoch'] > feed.last_ingest_epoch:
+                feed.set_last_ingest_time(state['last_trigger_time'])
+
+    def claim_feeds(self, feeds, now, retry_time):
+        """
+        Method to claim due feeds in the state store before triggering them.
+        Feeds leased or already triggered by another run are rescheduled
+        instead. If the state store cannot be reached, all due feeds are
+        rescheduled and the error is raised, so that the run fails rather than
+        silently skipping them or triggering them unleased.
+
+        Parameters:
+            feeds: array of due Feed objects.
+            now: datetime object of the current time.
+            retry_time: epoch time before which unclaimed feeds are not
+                scheduled again.
+
+        Returns:
+            An array of the claimed Feed objects.
+        """
+        try:
+            with self.metrics.timer('state_claim'):
+                claimed_ids = set(self.state_store.claim({feed.row_id: feed.last_ingest_epoch for feed in feeds},
+                                                         self.owner_id, self.lease_seconds, now.timestamp()))
+            skipped = [feed for feed in feeds if feed.row_id not in claimed_ids]
+            if skipped:
+                self.apply_state(skipped)
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Unable to claim {} due feeds in the state store.'.format(len(feeds)))
+            self.metrics.incr('state_claim_failed')
+            for feed in feeds:
+                self.scheduler.update(feed, not_before=retry_time)
+            raise
+        for feed in skipped:
+            self.scheduler.update(feed, not_before=retry_time)
+        if skipped:
+            self.print_func('Skip {} feeds claimed or already triggered by another run.'.format(len(skipped)))
+            self.metrics.incr('feeds_claimed_elsewhere', len(skipped))
+        return [feed for feed in feeds if feed.row_id in claimed_ids]
+
+    def complete_claims(self, feeds, results):
+        """
+        Method to record the trigger time of claimed feeds in the state store
+        and release their leases.
+
+        Parameters:
+            feeds: array of claimed Feed objects.
+            results: dictionary object with the feed's row ID as key and
+                'success' or 'failed' as value, as returned by trigger_feeds.
+        """
+        triggered = {feed.row_id: feed.last_ingest_time for feed in feeds if results[feed.row_id] == 'success'}
+        failed_ids = [feed.row_id for feed in feeds if results[feed.row_id] != 'success']
+        try:
+            with self.metrics.timer('state_complete'):
+                self.state_store.complete(triggered, self.owner_id)
+                self.state_store.release(failed_ids, self.owner_id)
+        except Exception:
+            self.print_func(traceback.format_exc())
+            self.print_func('Unable to record {} triggered feeds in the state store. Their leases expire in {} seconds.'.format(
+                len(triggered), self.lease_seconds))
+
+    def trigger_due_feeds(self, retry_delay=60):
+        """
+        Method to trigger ingestion for every scheduled feed that is due, then
+        reschedule them. Feeds that failed to trigger, or that are over the
+        trigger budget, are retried after `retry_delay` seconds.
+
+        Parameters:
+            retry_delay: Number of seconds to wait before retrying a feed that
+                failed to trigger or was deferred.
+
+        Returns:
+            Dictionary object with the feed's row ID as key and 'success' or
+            'failed' as value, as returned by trigger_feeds.
+        """
+        now = self.clock()
+        due_feeds = self.scheduler.pop_due(now)
+        retry_time = now.timestamp() + retry_delay
+        if self.trigger_budget is not None and len(due_feeds) > self.trigger_budget:
+            # feeds are popped in order of due time, so the most overdue go first
+            deferred_feeds = due_feeds[self.trigger_budget:]
+            due_feeds = due_feeds[:self.trigger_budget]
+            for feed in deferred_feeds:
+                self.scheduler.update(feed, not_before=retry_time)
+            self.print_func('Defer {} due feeds over the trigger budget of {}.'.format(len(deferred_feeds), self.trigger_budget))
+            self.metrics.incr('feeds_deferred', len(deferred_feeds))
+        if self.state_store and due_feeds:
+            due_feeds = self.claim_feeds(due_feeds, now, retry_time)
+        results = self.trigger_feeds(due_feeds)
+        if self.state_store and due_feeds:
+            self.complete_claims(due_feeds, results)
+        for feed in due_feeds:
+            if results[feed.row_id] == 'failed':
+                self.scheduler.update(feed, not_before=retry_time)
+            else:
+                self.scheduler.update(feed)
+        if self.defer_writeback:
+            self.maybe_flush_writebacks()
+        n_failed = list(results.values()).count('failed')
+        if n_failed:
+            self.print_func('{} ingestion failed to trigger.'.format(n_failed))
+        return results
+
+    def plan(self, feeds=None, now=None):
+        """
+        Method to list the feeds that would be triggered, without invoking any
+        lambda function or writing to the feed registry.
+
+        Parameters:
+            feeds: Optional array of Feed objects or dictionary objects of feed
+                registry records. If not given, the active feeds are read from the registry.
+            now: Optional datetime object of the time to plan for. Defaults to
+                the current time of the registry's clock.
+
+        Returns:
+            An array of dictionary objects, one per due feed (up to
+            trigger_budget) and sorted by due time, with the fields 'feedname', 'id', 'update_freq',
+            'last_ingest_time' and 'due_time' (None if the feed has never been
+            ingested).
+        """
+        if feeds is None:
+            feeds = self.get_active_feeds()
+        feeds = [self.as_feed(feed) for feed in feeds]
+        self.apply_known_ingest_times(feeds)
+        if self.state_store and feeds:
+            self.apply_state(feeds)
+        now = now or self.clock()
+        now_epoch = now.timestamp()
+        planned = []
+        for feed in sorted(feeds, key=self.scheduler.next_ingest_epoch):
+            next_ingest_epoch = self.scheduler.next_ingest_epoch(feed)
+            if next_ingest_epoch < now_epoch:
+                planned.append({
+                    'feedname': feed.feedname,
+                    'id': feed.row_id,
+                    'update_freq': feed.update_freq,
+                    'last_ingest_time': feed.last_ingest_time,
+                    'due_time': (datetime.fromtimestamp(next_ingest_epoch, now.tzinfo)
+                                 if feed.last_ingest_time else None)
+                })
+        if self.trigger_budget is not None:
+            planned = planned[:self.trigger_budget]
+        return planned
+
+    def ingest(self, dry_run=False):
+        """
+        Method to retrieve all active feeds from the WZDx Feed Registry and trigger
+        ingestion for each feed based on its last ingest time and update frequency.
+        The instance may be reused for several runs, e.g. by a warm lambda container.
+
+        Parameters:
+            dry_run: Optional boolean. If True, the feeds that would be triggered
+                are logged and returned, and nothing is triggered or written.
+
+        Returns:
+            The plan of due feeds (see `plan`) if dry_run is True, else None.
+        """
+        if dry_run:
+            planned = self.plan()
+            for feed in planned:
+                self.print_func('Would trigger {} for {} (due {})'.format(self.lambda_to_trigger, feed['feedname'], feed['due_time']))
+            self.print_func('{} ingestion would be triggered.'.format(len(planned)))
+            return planned
+
+        self.n_ingest_triggered = 0
+        self.feed_results = {}
+        self.writeback_results = {}
+        self.feed_batches = {}
+        self.metrics.reset()
+        n_feeds = self.refresh_schedule()
+        n_due = len(self.trigger_due_feeds())
+        self.print_func('Skip {} feeds not yet due.'.format(n_feeds - n_due))
+        if self.defer_writeback:
+            self.wait_for_writebacks()
+            self.flush_writebacks()
         self.print_func('{} ingestion triggered.'.format(self.n_ingest_triggered))
+        seconds_until_next_due = self.time_until_next_due()
+        if seconds_until_next_due is not None:
+            self.print_func('Next feed due in {:.0f} seconds.'.format(seconds_until_next_due))
+        self.metrics.emit()
+
+    def run_forever(self, stop_event, refresh_interval=300, max_sleep=60):
+        """
+        Method to trigger ingestion continuously instead of once per invocation.
+        Sleeps until the next feed is due, re-reads the feed registry every
+        `refresh_interval` seconds and returns once `stop_event` is set.
+        Pending "last ingested to sandbox" updates are flushed before returning.
+
+        Parameters:
+            stop_event: threading.Event object. Set it (e.g. from a signal
+                handler) to stop the loop.
+            refresh_interval: Number of seconds between reads of the feed registry.
+            max_sleep: Maximum number of seconds to sleep between checks for due
+                feeds. A failed read of the feed registry is retried after
+                this long.
+        """
+        next_refresh_time = time.time()
+        while not stop_event.is_set():
+            if time.time() >= next_refresh_time:
+                self.metrics.emit()
+                self.metrics.reset()
+                try:
+                    self.refresh_schedule()
+                    next_refresh_time = time.time() + refresh_interval
+                except Exception:
+                    self.print_func(traceback.format_exc())
+                    self.print_func('Unable to refresh feed registry. Keeping the current schedule and retrying in {} seconds.'.format(max_sleep))
+                    next_refresh_time = time.time() + min(refresh_interval, max_sleep)
+            try:
+                self.trigger_due_feeds()
+            except Exception:
+                self.print_func(traceback.format_exc())
+                self.print_func('Unable to trigger due feeds. They will be retried.')
+
+            sleep_time = min(max_sleep, max(0, next_refresh_time - time.time()))
+            seconds_until_next_due = self.time_until_next_due()
+            if seconds_until_next_due is not None:
+                sleep_time = min(sleep_time, seconds_until_next_due)
+            stop_event.wait(sleep_time)
+        if self.defer_writeback:
+            self.wait_for_writebacks()
+            self.flush_writebacks()
+        self.metrics.emit()
+        self.print_func('Stopped. {} ingestion triggered.'.format(self.n_ingest_triggered))
+
+    def time_until_next_due(self):
+        """
+        Method to get the number of seconds until the next scheduled feed is due,
+        so that the trigger cadence can adapt to the feed registry.
+
+        Returns:
+            Number of seconds (0 if a feed is already due), or None if no feeds
+            are scheduled.
+        """
+        return self.scheduler.time_until_next_due(self.clock())